@@ -0,0 +1,172 @@
+#Concurrent HTTP downloads with pooled connections, retries, resume, and atomic writes
+#Used by SPC_Outlook to fetch archive files in bulk
+
+#########
+#Imports#
+#########
+
+import os
+import time
+import socket
+import logging
+import threading
+import http.client
+from os.path import exists, dirname
+from urllib.parse import urlsplit, urljoin
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from VargaPy.Instrumentation import stage
+
+logger=logging.getLogger(__name__)
+
+#Errors after which a request is retried
+RETRY_ERRORS=(OSError, socket.timeout, http.client.HTTPException)
+#HTTP statuses after which a request is retried: timeouts, rate limiting, and every 5xx. Other 4xx (e.g. 404) are never retried
+RETRY_STATUSES=(408, 429)
+BLOCK_SIZE=1<<20
+
+
+class HTTPError(Exception):
+    '''Raised for HTTP error statuses. status holds the HTTP status code'''
+    def __init__(self, url, status, reason=''):
+        super().__init__(f'{status} {reason} for {url}')
+        self.url=url
+        self.status=status
+
+
+class ConnectionPool:
+    '''Keeps one persistent HTTP(S) connection per host for each thread, so repeated requests reuse the connection'''
+    '''Params:
+    timeout: socket timeout in seconds
+    '''
+
+    def __init__(self, timeout=60):
+        self.timeout=timeout
+        self._local=threading.local()
+
+    def get(self, scheme, netloc):
+        '''Returns this thread's connection to scheme://netloc, opening it if needed'''
+        conns=self._local.__dict__.setdefault('conns', {})
+        if (scheme, netloc) not in conns:
+            Connection=http.client.HTTPSConnection if scheme=='https' else http.client.HTTPConnection
+            conns[(scheme, netloc)]=Connection(netloc, timeout=self.timeout)
+        return conns[(scheme, netloc)]
+
+    def discard(self, scheme, netloc):
+        '''Closes and forgets this thread's connection to scheme://netloc, e.g. after an error'''
+        conns=self._local.__dict__.setdefault('conns', {})
+        conn=conns.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+
+def _request(pool, url, dest_part, max_redirects=5):
+    #Issues one GET for url, appending to dest_part if it holds a partial download. Returns the number of bytes written
+    for _ in range(max_redirects+1):
+        parts=urlsplit(url)
+        path=parts.path+(f'?{parts.query}' if parts.query else '')
+        offset=os.path.getsize(dest_part) if exists(dest_part) else 0
+        headers={'Connection':'keep-alive'}
+        if offset:
+            headers['Range']=f'bytes={offset}-' #Resume a partial download
+        conn=pool.get(parts.scheme, parts.netloc)
+        try:
+            conn.request('GET', path or '/', headers=headers)
+            resp=conn.getresponse()
+        except RETRY_ERRORS:
+            pool.discard(parts.scheme, parts.netloc)
+            raise
+
+        if resp.status in (301, 302, 303, 307, 308):
+            resp.read()
+            url=urljoin(url, resp.getheader('Location'))
+            continue
+        if resp.status==416: #Range not satisfiable: start over
+            resp.read()
+            os.remove(dest_part)
+            continue
+        if resp.status not in (200, 206):
+            resp.read()
+            raise HTTPError(url, resp.status, resp.reason)
+
+        mode='ab' if resp.status==206 else 'wb' #Servers that ignore Range send the whole file
+        written=0
+        try:
+            with open(dest_part, mode) as f:
+                while True:
+                    block=resp.read1(BLOCK_SIZE) #Returns what has arrived, so a stalled download keeps its partial data for resuming
+                    if not block:
+                        break
+                    f.write(block)
+                    written+=len(block)
+            resp.close() #read1 leaves the response open at the end of the body, and the connection only takes a new request once it is closed
+        except RETRY_ERRORS:
+            #The response was not read to the end, so the connection cannot be reused
+            pool.discard(parts.scheme, parts.netloc)
+            raise
+        expected=resp.getheader('Content-Length')
+        if expected is not None and written!=int(expected):
+            pool.discard(parts.scheme, parts.netloc)
+            raise http.client.IncompleteRead(b'', int(expected)-written)
+        return written
+    raise HTTPError(url, 310, 'Too many redirects')
+
+
+def fetch(url, dest, pool=None, retries=3, backoff=1., overwrite=False):
+    '''Downloads url to dest. Returns the number of bytes downloaded (0 if dest already exists)'''
+    '''Params:
+    url: http(s) URL to download
+    dest: local path. Data is written to dest.part and renamed when complete, so dest is never partially written
+    pool: ConnectionPool to reuse connections from. A new pool is used by default
+    retries: number of retries after a failed attempt. 4xx statuses other than 408 and 429 are not retried
+    backoff: seconds to wait before the first retry. Doubles with every retry
+    overwrite: If false, existing files are skipped
+    '''
+    if exists(dest) and not overwrite:
+        return 0
+    pool=ConnectionPool() if pool is None else pool
+    if dirname(dest):
+        os.makedirs(dirname(dest), exist_ok=True)
+    dest_part=dest+'.part'
+
+    for attempt in range(retries+1):
+        try:
+            written=_request(pool, url, dest_part)
+            os.replace(dest_part, dest)
+            return written
+        except HTTPError as err:
+            if (err.status<500 and err.status not in RETRY_STATUSES) or attempt==retries:
+                raise
+            error=err
+        except RETRY_ERRORS as err:
+            if attempt==retries:
+                raise
+            error=err
+        wait=backoff*2**attempt
+        logger.warning(f'Retrying {url} in {wait:.1f} s after {error!r}')
+        time.sleep(wait)
+
+
+def fetch_many(jobs, max_workers=8, retries=3, backoff=1., overwrite=False, pool=None):
+    '''Downloads many (url, dest) pairs concurrently on a bounded thread pool'''
+    '''Params:
+    jobs: iterable of (url, dest) pairs
+    max_workers: number of concurrent downloads
+    Other arguments are as in fetch
+    '''
+    '''Returns a dict of {dest: bytes downloaded, or the exception raised for that file}'''
+    pool=ConnectionPool() if pool is None else pool
+    jobs=list(jobs)
+    results={}
+    with stage('fetch_many', files=len(jobs)) as s:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures={executor.submit(fetch, url, dest, pool, retries, backoff, overwrite): (url, dest) for url, dest in jobs}
+            for future in as_completed(futures):
+                url, dest=futures[future]
+                try:
+                    results[dest]=future.result()
+                except Exception as err:
+                    logger.error(f'Failed to download {url}: {err!r}')
+                    results[dest]=err
+        failed=sum(isinstance(result, Exception) for result in results.values())
+        s.update(failed=failed, bytes_read=sum(result for result in results.values() if not isinstance(result, Exception)))
+    return results
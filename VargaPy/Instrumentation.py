@@ -0,0 +1,239 @@
+#Stage-level timing and memory instrumentation for VargaPy pipelines
+#Nothing is measured until a sink is added, so instrumented code runs at full speed by default
+
+'''Usage:
+    from VargaPy import Instrumentation as inst
+    collector=inst.MemoryCollector()
+    inst.add_sink(collector)
+    X, y, metadata = MlUtils.All_Severe(...)
+    print(collector.to_dataframe())
+'''
+
+#########
+#Imports#
+#########
+
+import json
+import time
+import logging
+import threading
+import functools
+
+logger=logging.getLogger(__name__)
+
+_sinks=[]
+_local=threading.local() #Stack of open stages for each thread
+#The peak RSS high water mark is process wide. Reads and resets are serialized, but a stage on one thread can still reset the
+#mark while a stage on another thread is open, so peak_rss_mb is only exact when stages run on one thread at a time
+_peak_lock=threading.Lock()
+
+
+def enabled():
+    '''Returns True if any sink is registered'''
+    return bool(_sinks)
+
+def add_sink(sink):
+    '''Registers a sink. A sink is any callable that takes an event dict'''
+    _sinks.append(sink)
+    return sink
+
+def remove_sink(sink):
+    '''Unregisters a sink, closing it if it has a close method'''
+    _sinks.remove(sink)
+    if hasattr(sink, 'close'):
+        sink.close()
+
+def clear_sinks():
+    '''Unregisters all sinks'''
+    for sink in list(_sinks):
+        remove_sink(sink)
+
+def emit(event):
+    '''Sends an event dict to every sink'''
+    for sink in _sinks:
+        sink(event)
+
+
+##########
+###RSS###
+##########
+
+def _read_status_kb(field):
+    #Reads a memory field (e.g. VmRSS, VmHWM) in kB from /proc/self/status. Returns None where /proc is unavailable
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field+':'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+def _reset_peak_rss():
+    #Resets the peak RSS high water mark (Linux >= 4.0). Returns False if it cannot be reset
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    '''Peak resident set size in MB, since the last reset where supported, otherwise over the life of the process'''
+    hwm=_read_status_kb('VmHWM')
+    if hwm is not None:
+        return hwm/1024
+    try:
+        import resource
+        import sys
+        maxrss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss/1024**2 if sys.platform=='darwin' else maxrss/1024 #bytes on macOS, kB on Linux
+    except ImportError:
+        return float('nan')
+
+def rss_mb():
+    '''Current resident set size in MB'''
+    rss=_read_status_kb('VmRSS')
+    return float('nan') if rss is None else rss/1024
+
+
+############
+###Stages###
+############
+
+class _NullStage:
+    '''Returned by stage() when instrumentation is disabled. Every method is a no-op'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def update(self, **fields):
+        pass
+
+_NULL_STAGE=_NullStage()
+
+
+class Stage:
+    '''Times a block of code and records its peak RSS and any fields added with update()'''
+    '''peak_rss_mb is process wide: with stages open on several threads (e.g. the Stream_All_Severe prefetch thread) it is a lower bound'''
+    '''Params:
+    name: name of the stage. Nested stages are reported as parent/child
+    fields: initial fields of the event, e.g. rows, cols, bytes_read
+    '''
+
+    def __init__(self, name, **fields):
+        self.name=name
+        self.fields=fields
+        self.peak=0.
+
+    def update(self, **fields):
+        '''Adds or replaces fields of the event'''
+        self.fields.update(fields)
+
+    def __enter__(self):
+        stack=getattr(_local, 'stack', None)
+        if stack is None:
+            stack=_local.stack=[]
+        self.parent=stack[-1] if stack else None
+        self.path=f'{self.parent.path}/{self.name}' if self.parent else self.name
+        stack.append(self)
+        self.rss_start=rss_mb()
+        with _peak_lock:
+            #The high water mark is about to be reset, so the parent keeps the peak it reached before this stage opened
+            if self.parent is not None:
+                self.parent.peak=max(self.parent.peak, peak_rss_mb())
+            _reset_peak_rss()
+        self.t0=time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed=time.perf_counter()-self.t0
+        #A child stage resets the high water mark, so the parent keeps the max of its children's peaks
+        with _peak_lock:
+            self.peak=max(self.peak, peak_rss_mb())
+        _local.stack.pop()
+        if self.parent is not None:
+            self.parent.peak=max(self.parent.peak, self.peak)
+
+        event={'stage':self.path, 'time_s':elapsed, 'rss_start_mb':self.rss_start, 'rss_end_mb':rss_mb(), 'peak_rss_mb':self.peak}
+        if exc_type is not None:
+            event['error']=exc_type.__name__
+        event.update(self.fields)
+        emit(event)
+        return False
+
+
+def stage(name, **fields):
+    '''Context manager that records a stage. Returns a no-op stage when no sinks are registered'''
+    if not _sinks:
+        return _NULL_STAGE
+    return Stage(name, **fields)
+
+def current_stage():
+    '''Returns the innermost open stage on this thread, or a no-op stage'''
+    stack=getattr(_local, 'stack', None)
+    return stack[-1] if stack else _NULL_STAGE
+
+def instrumented(name=None):
+    '''Decorator that runs the function inside a stage named after it'''
+    def decorate(func):
+        stage_name=name or func.__qualname__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return func(*args, **kwargs)
+            with Stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+###########
+###Sinks###
+###########
+
+class LoggingSink:
+    '''Sink that writes each event to a logger'''
+    def __init__(self, logger=logger, level=logging.INFO):
+        self.logger=logger
+        self.level=level
+
+    def __call__(self, event):
+        fields=' '.join(f'{key}={value:.4g}' if isinstance(value, float) else f'{key}={value}' for key, value in event.items() if key!='stage')
+        self.logger.log(self.level, f'{event["stage"]}: {fields}')
+
+
+class JsonLinesSink:
+    '''Sink that appends each event as a line of JSON to path'''
+    def __init__(self, path):
+        self.path=path
+        self._file=open(path, 'a')
+        self._lock=threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self._file.write(json.dumps(event, default=str)+'\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class MemoryCollector:
+    '''Sink that keeps events in memory'''
+    def __init__(self):
+        self.events=[]
+
+    def __call__(self, event):
+        self.events.append(event)
+
+    def to_dataframe(self):
+        '''Returns the events as a dataframe, one row per stage'''
+        import pandas as pd
+        return pd.DataFrame(self.events)
+
+    def summary(self):
+        '''Returns total time, number of calls and max peak RSS for each stage'''
+        return self.to_dataframe().groupby('stage').agg(calls=('time_s', 'size'), time_s=('time_s', 'sum'), peak_rss_mb=('peak_rss_mb', 'max'))
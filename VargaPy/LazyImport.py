@@ -0,0 +1,30 @@
+#Deferred imports for heavy optional dependencies (geopandas, matplotlib, pandas, ...)
+#A LazyModule stands in for a module and imports it the first time one of its attributes is used
+
+import importlib
+
+
+class LazyModule:
+    '''Proxy that imports the module name on first attribute access'''
+    '''Params:
+    name: full module name, e.g. 'geopandas' or 'matplotlib.patches'
+    '''
+
+    def __init__(self, name):
+        self.__dict__['_name']=name
+        self.__dict__['_module']=None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module']=importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state='loaded' if self._module is not None else 'not loaded'
+        return f'<LazyModule {self._name} ({state})>'
@@ -5,13 +5,54 @@
 #########
 
 import sys
-sys.path.append('/home/samuel.varga/python_packages/ml_workflow/') #ML_workflow package by mflora
-sys.path.append('/home/samuel.varga/projects/2to6_hr_severe_wx/') #2-6 ML repo by mflora
-from main.io import load_ml_data 
-import pandas as pd
+import importlib
+import importlib.util
 import numpy as np
 import argparse
 import numpy.random as npr
+import os
+import glob
+import json
+import shutil
+import hashlib
+import time
+import logging
+import threading
+from queue import Queue, Empty, Full
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from os.path import join, exists, getmtime, getsize
+from VargaPy.Instrumentation import stage, instrumented, current_stage
+from VargaPy.LazyImport import LazyModule
+
+pd=LazyModule('pandas') #Imported the first time it is used
+pa=LazyModule('pyarrow')
+pads=LazyModule('pyarrow.dataset')
+
+logger=logging.getLogger(__name__)
+
+#Directories added to sys.path the first time main.io is needed
+ML_REPO_PATHS=['/home/samuel.varga/python_packages/ml_workflow/', #ML_workflow package by mflora
+               '/home/samuel.varga/projects/2to6_hr_severe_wx/'] #2-6 ML repo by mflora
+
+def _add_ml_repo_paths():
+    for path in ML_REPO_PATHS:
+        if path not in sys.path:
+            sys.path.append(path)
+
+def load_ml_data(*args, **kwargs):
+    '''Calls main.io.load_ml_data, importing the 2-6 ML repo on first use. See main.io for arguments'''
+    _add_ml_repo_paths()
+    return importlib.import_module('main.io').load_ml_data(*args, **kwargs)
+
+def _ml_io_source():
+    #Path of main/io.py, found without importing it
+    _add_ml_repo_paths()
+    try:
+        spec=importlib.util.find_spec('main.io')
+    except ImportError:
+        return None
+    return spec.origin if spec is not None else None
 
 
 def Train_Ml_Parser():
@@ -24,15 +65,134 @@ def Train_Ml_Parser():
     parser.add_argument('-env','--environmental', help="Drop all intrastorm variables", action='store_true')
     parser.add_argument('-is' ,'--intrastorm', help="Drop all environmental variables", action='store_true')
     parser.add_argument('--SigSevere', action='store_true', help='Train Using Sig Severe as Targets')
+    parser.add_argument('-df', '--data_file', help="Feather file read by load_ml_data. Targets for additional hazards are read from it directly")
     return parser
 
-def All_Severe(base_path, mode='train', target_scale=36, FRAMEWORK='POTVIN', TIMESCALE='2to6', full_9km=True, SigSevere=False, appendUH=False, Three_km=False):
+HAZARDS=['wind','hail','tornado']
+
+def hazard_target_col(hazard, target_scale, SigSevere=False):
+    '''Returns the target column name for a hazard, e.g. hail_severe__36km or hail_sig_severe__36km'''
+    if SigSevere:
+        return '{}_sig_severe__{}km'.format(hazard, target_scale)
+    return '{}_severe__{}km'.format(hazard, target_scale)
+
+def load_ml_targets(data_file, target_cols):
+    '''Reads only the target columns from an ML feather file'''
+    '''data_file: Path like. Feather file that load_ml_data reads for the requested mode/FRAMEWORK/TIMESCALE
+    target_cols: list. Target columns to read. Only these columns are read from disk'''
+    
+    '''Returns a dict of {target_col: array}'''
+    with stage('load_ml_targets', path=str(data_file)) as s:
+        df=pd.read_feather(data_file, columns=list(target_cols))
+        s.update(rows=len(df), cols=len(target_cols), bytes_read=int(df.memory_usage(index=False).sum()))
+    return {col: df[col].to_numpy() for col in target_cols}
+
+def _frame_bytes(df):
+    return int(df.memory_usage(index=False, deep=True).sum())
+
+def _smallest_int_type(low, high):
+    #Narrowest integer dtype holding both low and high. Unsigned when low>=0
+    if low>=0:
+        return np.min_scalar_type(high)
+    return next(np.dtype(t) for t in (np.int8, np.int16, np.int32, np.int64) if np.iinfo(t).min<=low and high<=np.iinfo(t).max)
+
+def compact_dtypes(X, ys, metadata, float_dtype=np.float32, target_dtype=np.uint8, categorical_metadata=True, mmap_path=None):
+    '''Downcasts a loaded dataset to compact dtypes and reports the memory saved'''
+    '''X: dataframe of predictors. Floating point columns become float_dtype; integer columns (e.g. NX, NY) are downcast to the smallest integer type
+    ys: array, or dict of arrays, of targets. Converted to target_dtype
+    metadata: dataframe. Text columns become categoricals if categorical_metadata
+    mmap_path: Path like. If given, X is cast to float_dtype, saved to this .npy file, and returned backed by a read-only memory map'''
+    
+    '''Returns X, ys, metadata with the new dtypes'''
+    before=_frame_bytes(X)+_frame_bytes(metadata)
+    
+    if mmap_path is not None:
+        np.save(mmap_path, X.to_numpy(dtype=float_dtype))
+        X=pd.DataFrame(np.load(mmap_path, mmap_mode='r'), columns=X.columns, copy=False)
+    else:
+        casts={}
+        for col, dtype in X.dtypes.items():
+            if np.issubdtype(dtype, np.floating):
+                casts[col]=float_dtype
+            elif np.issubdtype(dtype, np.integer):
+                casts[col]=_smallest_int_type(X[col].min(), X[col].max()) if len(X) else dtype
+        X=X.astype(casts, copy=False) #One astype for every column
+    
+    def _targets(y):
+        y=np.asarray(y)
+        if len(y) and (y.min()<np.iinfo(target_dtype).min or y.max()>np.iinfo(target_dtype).max):
+            raise ValueError(f'Targets range from {y.min()} to {y.max()}, which does not fit in {np.dtype(target_dtype)}')
+        return y.astype(target_dtype, copy=False)
+    ys={hazard: _targets(y) for hazard, y in ys.items()} if isinstance(ys, dict) else _targets(ys)
+    
+    if categorical_metadata:
+        text=[col for col, dtype in metadata.dtypes.items() if dtype==object or pd.api.types.is_string_dtype(dtype)]
+        metadata=metadata.astype({col: 'category' for col in text})
+    
+    after=(0 if mmap_path is not None else _frame_bytes(X))+_frame_bytes(metadata)
+    logger.info(f'Compact dtypes: {before/1024**2:.1f} MB -> {after/1024**2:.1f} MB in memory'+(' (X memory mapped)' if mmap_path is not None else ''))
+    current_stage().update(bytes_before=before, bytes_after=after)
+    return X, ys, metadata
+
+def _apply_dtype_policy(X, ys, metadata, dtype_policy):
+    #dtype_policy: None (leave dtypes alone), 'compact', or a dict of compact_dtypes arguments
+    if dtype_policy is None:
+        return X, ys, metadata
+    kwargs={} if dtype_policy=='compact' else dict(dtype_policy)
+    with stage('compact_dtypes'):
+        return compact_dtypes(X, ys, metadata, **kwargs)
+
+def Load_Hazards(base_path, hazards=HAZARDS, mode='train', target_scale=36, FRAMEWORK='POTVIN', TIMESCALE='2to6', full_9km=True, SigSevere=False, appendUH=False, Three_km=False, data_file=None, dtype_policy=None):
+    '''Loads the predictors once, along with the targets for each hazard in hazards'''
+    '''hazards: list. Hazards to load targets for. Valid: ['wind','hail','tornado']. The predictors are loaded with the first hazard's target
+    data_file: Path like. Feather file that load_ml_data reads for these settings. If given, the targets for the remaining hazards
+               are read from it with column projection. Otherwise the remaining targets are loaded through load_ml_data
+    dtype_policy: None, 'compact', or dict of compact_dtypes arguments. 'compact' gives float32 predictors, uint8 targets, and categorical metadata
+    Other arguments are as in All_Severe'''
+    
+    '''Return values:
+    X: dataset of predictors
+    ys: dict of {hazard: array of targets corresponding to X}
+    metadata: metadata about the ML file '''
+    target_cols={hazard: hazard_target_col(hazard, target_scale, SigSevere) for hazard in hazards}
+    with stage('load_ml_data', target_col=target_cols[hazards[0]]) as s:
+        X, y, metadata = load_ml_data(base_path=base_path,
+                                          mode=mode,
+                                          target_col=target_cols[hazards[0]],
+                                          FRAMEWORK=FRAMEWORK,
+                                          TIMESCALE=TIMESCALE, appendUH=appendUH, Three_km=Three_km, full_9km=full_9km)
+        s.update(rows=X.shape[0], cols=X.shape[1], bytes_read=int(X.memory_usage(index=False).sum()))
+    ys={hazards[0]: y}
+    
+    remaining=hazards[1:]
+    if remaining and data_file is not None:
+        targets=load_ml_targets(data_file, [target_cols[hazard] for hazard in remaining])
+        for hazard in remaining:
+            if len(targets[target_cols[hazard]])!=len(y):
+                raise ValueError(f'{data_file} has {len(targets[target_cols[hazard]])} rows, but load_ml_data returned {len(y)}. '
+                                 'data_file must be the file load_ml_data reads for these settings')
+            ys[hazard]=targets[target_cols[hazard]]
+    else:
+        for hazard in remaining:
+            with stage('load_ml_data', target_col=target_cols[hazard]):
+                _, ys[hazard], _  = load_ml_data(base_path=base_path,
+                                               mode=mode,
+                                               target_col=target_cols[hazard],
+                                               FRAMEWORK=FRAMEWORK,
+                                               TIMESCALE=TIMESCALE, Three_km=Three_km, full_9km=full_9km) 
+    return _apply_dtype_policy(X, ys, metadata, dtype_policy)
+
+@instrumented('All_Severe')
+def All_Severe(base_path, mode='train', target_scale=36, FRAMEWORK='POTVIN', TIMESCALE='2to6', full_9km=True, SigSevere=False, appendUH=False, Three_km=False, data_file=None, hazards=HAZARDS, dtype_policy=None):
     '''base_path: Path like. Directory where ML feather files are located'''
     '''mode : str. Determines whether to load the training or testing dataset. Valid: ['train', 'test']'''
     '''target_scale: int. radius of target sizes in km. Valid: [9,18,36]'''
     '''Framework: str. Data framework to use. Determines the filepath. Valid: ['ADAM','POTVIN']'''
     '''Timescale: str. Time window for ML predictions. Determines the filepath. Valid: ['0to3','2to6']'''
     '''SigSevere: Bool. Flag used to train on sig-severe'''
+    '''data_file: Path like. Feather file read by load_ml_data. If given, hail/tornado targets are read without reloading the predictors'''
+    '''hazards: list. Hazards combined into the target. A single hazard gives a per-hazard target'''
+    '''dtype_policy: None, 'compact', or dict of compact_dtypes arguments. 'compact' gives float32 predictors, uint8 targets, and categorical metadata'''
     
     '''Loads the ML dataset with all severe weather types labeled as targets'''
     
@@ -41,37 +201,235 @@ def All_Severe(base_path, mode='train', target_scale=36, FRAMEWORK='POTVIN', TIM
     y: array of all-severe targets corresponding to X
     metadata: metadata about the ML file '''
     #Data used for bulk training and evaluation - returns X, y, metadata
-    if SigSevere:
-        target_col=f'wind_sig_severe__{target_scale}km'
-    else:
-        target_col=f'wind_severe__{target_scale}km'
-    X, y, metadata = load_ml_data(base_path=base_path,
-                                      mode=mode,
-                                      target_col=target_col,
-                                      FRAMEWORK=FRAMEWORK,
-                                      TIMESCALE=TIMESCALE, appendUH=appendUH, Three_km=Three_km, full_9km=full_9km)
-    print(len(y[y>0])) #Number of points with wind targets
-    for hazard in ['hail','tornado']:
-        if SigSevere:
-            target_col='{}_sig_severe__{}km'.format(hazard, target_scale)
-        else:
-            target_col='{}_severe__{}km'.format(hazard, target_scale)
-        _, y1, _  = load_ml_data(base_path=base_path,
-                                           mode=mode,
-                                           target_col=target_col,
-                                           FRAMEWORK=FRAMEWORK,
-                                           TIMESCALE=TIMESCALE, Three_km=Three_km, full_9km=full_9km) 
-        y +=y1
-        print(len(y[y>0])) #Prints the number of wind+hail targets, then wind+hail+tornado
+    X, ys, metadata = Load_Hazards(base_path, hazards=hazards, mode=mode, target_scale=target_scale, FRAMEWORK=FRAMEWORK,
+                                   TIMESCALE=TIMESCALE, full_9km=full_9km, SigSevere=SigSevere, appendUH=appendUH,
+                                   Three_km=Three_km, data_file=data_file, dtype_policy=dtype_policy)
+    y=np.zeros(len(ys[hazards[0]]), dtype=np.asarray(ys[hazards[0]]).dtype)
+    n_targets={}
+    for hazard in hazards:
+        y +=ys[hazard]
+        n_targets[f'targets_{hazard}']=int(np.count_nonzero(y)) #Number of wind targets, then wind+hail, then wind+hail+tornado
+    logger.info(f'All_Severe cumulative target counts: {n_targets}')
 
     y[y > 0] = 1 #All target points (y>1) are remapped to y=1
     
+    #Adds the counts and the shape of the result to the All_Severe stage when instrumentation is enabled
+    current_stage().update(rows=X.shape[0], cols=X.shape[1], **n_targets)
     return X, y, metadata
     
 
 
 
-def Drop_Unwanted_Variables(X, original=False, training_scale=False, intrastormOnly=False,  envOnly=False, dropList=None):
+#Bump when the layout of cached datasets changes so old entries are never reused
+CACHE_VERSION=2
+
+def _source_signature(paths, hash_files=False):
+    '''Returns a list describing each source file: path, size, and mtime, or a sha256 of the contents if hash_files'''
+    signature=[]
+    for path in sorted(set(paths)):
+        if hash_files:
+            digest=hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1<<24), b''):
+                    digest.update(block)
+            signature.append([path, getsize(path), digest.hexdigest()])
+        else:
+            signature.append([path, getsize(path), getmtime(path)])
+    return signature
+
+def dataset_cache_key(params, source_files, hash_files=False):
+    '''Returns the cache key for a dataset built with params from source_files'''
+    '''params: dict. Loader arguments, e.g. mode, target_scale, FRAMEWORK, TIMESCALE
+    source_files: list. Files the dataset is built from. Changing any of them invalidates the entry
+    hash_files: Bool. If true, files are identified by a hash of their contents instead of their mtime'''
+    desc={'version':CACHE_VERSION, 'params':params, 'sources':_source_signature(source_files, hash_files)}
+    return hashlib.sha256(json.dumps(desc, sort_keys=True, default=str).encode()).hexdigest()[:32], desc
+
+def save_cached_dataset(entry_dir, X, y, metadata, desc=None):
+    '''Saves X, y, and metadata to entry_dir. Numeric columns of X are stored as .npy blocks, one per dtype, so they can be reopened with memory maps'''
+    tmp_dir=entry_dir+f'.tmp{os.getpid()}'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    
+    #Numeric predictors are stored as one .npy block per dtype (e.g. float32 predictors, int64 NX/NY), so every column keeps
+    #its dtype and can be memory mapped. Blocks are Fortran ordered so each column is a contiguous view. Anything else goes to feather
+    blocks, other=[], []
+    for dtype in dict.fromkeys(X.dtypes):
+        cols=[col for col in X.columns if X[col].dtype==dtype]
+        if isinstance(dtype, np.dtype) and np.issubdtype(dtype, np.number):
+            blocks.append({'file':f'X{len(blocks)}.npy', 'columns':cols})
+            np.save(join(tmp_dir, blocks[-1]['file']), np.asfortranarray(X[cols].to_numpy(dtype=dtype)))
+        else:
+            other+=cols
+    if other:
+        X[other].reset_index(drop=True).to_feather(join(tmp_dir, 'X.feather'))
+    np.save(join(tmp_dir, 'y.npy'), np.asarray(y))
+    metadata.reset_index(drop=True).to_feather(join(tmp_dir, 'metadata.feather'))
+    with open(join(tmp_dir, 'entry.json'), 'w') as f:
+        json.dump({'columns':list(X.columns), 'blocks':blocks, 'desc':desc}, f, default=str)
+    
+    #Swap the finished entry in so a partially written entry is never read
+    shutil.rmtree(entry_dir, ignore_errors=True)
+    os.rename(tmp_dir, entry_dir)
+
+def load_cached_dataset(entry_dir, mmap=True):
+    '''Loads X, y, metadata saved by save_cached_dataset, with the dtypes they were saved with. If mmap, the numeric columns of X and y are read-only memory maps'''
+    with open(join(entry_dir, 'entry.json')) as f:
+        entry=json.load(f)
+    mmap_mode='r' if mmap else None
+    columns={}
+    for block in entry['blocks']:
+        values=np.load(join(entry_dir, block['file']), mmap_mode=mmap_mode)
+        columns.update({col: values[:, j] for j, col in enumerate(block['columns'])})
+    if exists(join(entry_dir, 'X.feather')):
+        other=pd.read_feather(join(entry_dir, 'X.feather'))
+        columns.update({col: other[col] for col in other.columns})
+    #Built from column views with copy=False, so memory mapped blocks are not read into memory
+    X=pd.DataFrame({col: columns[col] for col in entry['columns']}, copy=False)
+    y=np.load(join(entry_dir, 'y.npy'), mmap_mode=mmap_mode)
+    metadata=pd.read_feather(join(entry_dir, 'metadata.feather'))
+    os.utime(join(entry_dir, 'entry.json')) #Marks the entry as recently used for eviction
+    return X, y, metadata
+
+def _entry_size(entry_dir):
+    return sum(getsize(join(entry_dir, f)) for f in os.listdir(entry_dir))
+
+def evict_dataset_cache(cache_dir, max_bytes, keep=()):
+    '''Deletes the least recently used cache entries until the cache is at most max_bytes. Entries in keep are never deleted'''
+    entries=[d for d in glob.glob(join(cache_dir, '*')) if exists(join(d, 'entry.json'))]
+    entries.sort(key=lambda d: getmtime(join(d, 'entry.json')))
+    total=sum(_entry_size(d) for d in entries)
+    for entry_dir in entries:
+        if total<=max_bytes:
+            break
+        if entry_dir in keep:
+            continue
+        total-=_entry_size(entry_dir)
+        logger.info(f'Evicting {entry_dir} from dataset cache')
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+def _ml_source_files(base_path, mode, TIMESCALE, data_file=None):
+    #The feather file(s) load_ml_data reads for mode/TIMESCALE: data_file if given, otherwise the files in base_path whose names contain
+    #both '{TIMESCALE}hr' and '_{mode}'. That naming is a guess at load_ml_data's; an empty list means the source is unknown
+    if data_file is not None:
+        return [data_file]
+    return [path for path in glob.glob(join(base_path, '*.feather'))
+            if f'{TIMESCALE}hr' in os.path.basename(path) and f'_{mode}' in os.path.basename(path)]
+
+def Cached_All_Severe(base_path, cache_dir, mode='train', target_scale=36, FRAMEWORK='POTVIN', TIMESCALE='2to6', full_9km=True, SigSevere=False, appendUH=False, Three_km=False, data_file=None, hazards=HAZARDS,
+                      max_cache_bytes=100*1024**3, hash_files=False, mmap=True, dtype_policy=None):
+    '''All_Severe with a persistent on-disk cache of the assembled (X, y, metadata)'''
+    '''cache_dir: Path like. Directory where cached datasets are stored
+    max_cache_bytes: int. Least recently used entries are deleted when the cache grows beyond this size
+    hash_files: Bool. Identify source files by a hash of their contents instead of their mtime. Slower, but survives copies/touches
+    mmap: Bool. If true, X and y are returned as read-only memory maps. Copy y before modifying it
+    dtype_policy: as in All_Severe, and part of the key. Every column keeps its dtype in the cache
+    Other arguments are as in All_Severe. The file load_ml_data reads (data_file, or the feather file in base_path named for mode and TIMESCALE)
+    and the source of load_ml_data form part of the key. Pass data_file to avoid the lookup, especially with hash_files.
+    If no data_file is given and no feather file in base_path is named for mode and TIMESCALE, the data is loaded without the cache'''
+    
+    '''Return values are as in All_Severe'''
+    params={'mode':mode, 'target_scale':target_scale, 'FRAMEWORK':FRAMEWORK, 'TIMESCALE':TIMESCALE, 'full_9km':full_9km,
+            'SigSevere':SigSevere, 'appendUH':appendUH, 'Three_km':Three_km, 'hazards':list(hazards), 'dtype_policy':dtype_policy}
+    source_files=_ml_source_files(base_path, mode, TIMESCALE, data_file)
+    if not source_files:
+        #Without the source file the key cannot notice the data changing, so a cached entry could go stale unnoticed
+        logger.warning(f'No feather file for mode={mode}, TIMESCALE={TIMESCALE} in {base_path}; loading without the cache. Pass data_file to cache')
+        return All_Severe(base_path, mode=mode, target_scale=target_scale, FRAMEWORK=FRAMEWORK, TIMESCALE=TIMESCALE, full_9km=full_9km,
+                          SigSevere=SigSevere, appendUH=appendUH, Three_km=Three_km, data_file=data_file, hazards=hazards, dtype_policy=dtype_policy)
+    if _ml_io_source() is not None:
+        source_files.append(_ml_io_source())
+    key, desc=dataset_cache_key(params, source_files, hash_files)
+    entry_dir=join(cache_dir, key)
+    
+    if exists(join(entry_dir, 'entry.json')):
+        logger.info(f'Loading cached dataset {entry_dir}')
+        with stage('load_cached_dataset', path=entry_dir, bytes_read=_entry_size(entry_dir)):
+            return load_cached_dataset(entry_dir, mmap=mmap)
+    
+    X, y, metadata = All_Severe(base_path, mode=mode, target_scale=target_scale, FRAMEWORK=FRAMEWORK, TIMESCALE=TIMESCALE, full_9km=full_9km,
+                                SigSevere=SigSevere, appendUH=appendUH, Three_km=Three_km, data_file=data_file, hazards=hazards, dtype_policy=dtype_policy)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_cached_dataset(entry_dir, X, y, metadata, desc)
+    evict_dataset_cache(cache_dir, max_cache_bytes, keep=(entry_dir,))
+    return load_cached_dataset(entry_dir, mmap=mmap)
+
+#Intrastorm variables. All other variables are environmental.
+ENS_VARS=['uh_2to5_instant',
+          'uh_0to2_instant',
+          'wz_0to2_instant',
+          'comp_dz',
+          'ws_80',
+          'hailcast',
+          'w_up',
+          'okubo_weiss',
+          ]
+
+PREDICTOR_PARTS=['variable','category','neighborhood','statistic']
+
+def parse_predictor_names(Cols):
+    '''Splits predictor names of the form variable__category__neighborhood__statistic into their parts'''
+    '''Cols- list of variable names'''
+    '''Returns a dataframe with one categorical column per part. Init Time variables are time_avg/4km/N/A.
+    As with name.split('__')[i], parts after the fourth are ignored. Names with fewer than four parts get NaN for the missing ones'''
+    names=pd.Series(Cols, dtype=object)
+    parts=names.str.split('__', expand=True).reindex(columns=range(4)).astype(object) #Parts missing from every name would be float NaN columns
+    parts.columns=PREDICTOR_PARTS
+    init_time=names.str.contains('Init Time', regex=False).to_numpy()
+    parts.loc[init_time, PREDICTOR_PARTS[1:]]=['time_avg','4km','N/A']
+    return parts.astype('category')
+
+class PredictorIndex:
+    '''Index of predictor names, parsed once into their parts, that column selections can be run against as boolean masks'''
+    '''Params:
+    columns: list of predictor names, e.g. X.columns
+    '''
+    
+    def __init__(self, columns):
+        self.columns=pd.Index(columns)
+        self.parts=parse_predictor_names(self.columns)
+        #Names of the variable__category__neighborhood__statistic form (and Init Time). Other names, such as the NMEP baselines
+        #(uh_2to5_instant__nmep_>75_9km) or NX/NY, have no reliable parts, so part tests fall back to their full names
+        n_parts=np.asarray(self.columns.str.count('__'), dtype=np.int64)+1
+        self.parsed=np.asarray(self.parts.notna().all(axis=1), dtype=bool) & (n_parts<=len(PREDICTOR_PARTS))
+        self._masks={} #Substring masks, computed once per token
+    
+    def contains(self, token):
+        '''Boolean mask of the predictors whose name contains token'''
+        if token not in self._masks:
+            self._masks[token]=np.asarray(self.columns.str.contains(token, regex=False), dtype=bool)
+        return self._masks[token]
+    
+    def contains_any(self, tokens):
+        '''Boolean mask of the predictors whose name contains any of tokens'''
+        mask=np.zeros(len(self.columns), dtype=bool)
+        for token in tokens:
+            mask|=self.contains(token)
+        return mask
+    
+    def part_contains(self, part, tokens):
+        '''Boolean mask of the predictors whose name part (variable, category, neighborhood, statistic) contains any of tokens'''
+        '''Names without the four parts are tested on their full name, as contains_any does'''
+        '''The test runs once per distinct value of the part and is mapped to the columns through the categorical codes'''
+        key=(part, tuple(tokens))
+        if key not in self._masks:
+            values=self.parts[part]
+            matches=np.array([any(token in value for token in tokens) for value in values.cat.categories]+[False], dtype=bool)
+            mask=matches[values.cat.codes.to_numpy()] #Code -1 (no such part) maps to the trailing False
+            self._masks[key]=np.where(self.parsed, mask, self.contains_any(tokens))
+        return self._masks[key]
+
+_predictor_indexes={}
+
+def predictor_index(columns):
+    '''Returns the PredictorIndex for columns, reusing it if the same columns were indexed before'''
+    key=tuple(columns)
+    if key not in _predictor_indexes:
+        _predictor_indexes[key]=PredictorIndex(key)
+    return _predictor_indexes[key]
+
+@instrumented('Drop_Unwanted_Variables')
+def Drop_Unwanted_Variables(X, original=False, training_scale=False, intrastormOnly=False,  envOnly=False, dropList=None, index=None):
     '''Function that removes unwanted columns from X '''
     '''Arguments:
        X: input dataframe created by All_Severe or load_ml_data
@@ -80,56 +438,53 @@ def Drop_Unwanted_Variables(X, original=False, training_scale=False, intrastormO
        intrastormOnly:
        envOnly: '''
     '''dropList: list. drops any variable that matches a list entry'''
+    '''index: PredictorIndex for X.columns. By default a cached index is looked up from the columns'''
     '''Returns X-like dataframe with fewer columns, and ts_suff/var_suff which are a suffix to be appended to the ML model'''
     
-    #Dictionary of intrastorm variables. All other variables are environmental. 
-    varDic={ 'ENS_VARS':  ['uh_2to5_instant',
-                                'uh_0to2_instant',
-                                'wz_0to2_instant',
-                                'comp_dz',
-                                'ws_80',
-                                'hailcast',
-                                'w_up',
-                                'okubo_weiss',
-                        ]}
-    X=X[[col for col in X.columns if col not in ['NX','NY']]]
+    #Columns are selected with boolean masks over the index, and X is only projected once at the end
+    cols_in=X.shape[1]
+    index=predictor_index(X.columns) if index is None else index
+    keep=~index.columns.isin(['NX','NY'])
     
+    #Scale, statistic, and storm variable tests run on the parsed name parts. They keep the substring semantics of the original
+    #code within each part (e.g. '9km' in the neighborhood, 'uh_2to5_instant' in the variable)
     if training_scale: #Removes all columns except for those with correct neighborhood scale
-        X=X[[col for col in X.columns if '{}km'.format(training_scale) in col]] 
+        keep&=index.part_contains('neighborhood', ['{}km'.format(training_scale)])
         ts_suff=str(training_scale)+'km'
     else:
         ts_suff='all'
     
     if original:
-        print("Using Original Variables- Dropping IQR, 2nd lowest, 2nd highest, and intrastorm mean")
-        X=X[[col for col in X.columns if 'IQR' not in col]] #Drops IQR for all IS vars
-        X=X[[col for col in X.columns if '2nd' not in col]] #Drops 2nd lowest ens. member value for all IS vars
-        X=X[[col for col in X.columns if '16th' not in col]] #Drops 2nd highest ens. member value for all IS vars
-        badCols=np.array([])
-        for strmvar in vardic['ENS_VARS']:
-            badCols=np.append(badCols, [col for col in X.columns if 'mean' in col and strmvar in col] )
-
-        X=X.drop(badCols, axis=1)
+        logger.info("Using Original Variables- Dropping IQR, 2nd lowest, 2nd highest, and intrastorm mean")
+        keep&=~index.part_contains('statistic', ['IQR', #Drops IQR for all IS vars
+                                                 '2nd', #Drops 2nd lowest ens. member value for all IS vars
+                                                 '16th']) #Drops 2nd highest ens. member value for all IS vars
+        keep&=~(index.part_contains('statistic', ['mean']) & index.part_contains('variable', ENS_VARS))
     else: #Drops 90th %ile computed w/ extrapolation
-        print("Using new variables- dropping old 90th percentile")
-        X=X[[col for col in X.columns if '90th' not in col]] #Keeps all columns except the old 90th %ile
-
+        logger.info("Using new variables- dropping old 90th percentile")
+        keep&=~index.part_contains('statistic', ['90th']) #Keeps all columns except the old 90th %ile
+    
+    positions=None
     if envOnly or intrastormOnly: #Drops all intrastorm variables or drops all environmental variables
-        badCols=np.array([])
-        for strmvar in varDic['ENS_VARS']: 
-            badCols=np.append(badCols, [col for col in X.columns if strmvar in col]) #Every column that has a storm var
         if envOnly:
-            print("Dropping all intrastorm variables")
-            X=X.drop(badCols, axis=1) #Drops all intrastorm variables
+            logger.info("Dropping all intrastorm variables")
+            keep&=~index.part_contains('variable', ENS_VARS) #Every column that has a storm var
         elif intrastormOnly:
-            print("Dropping all environmental variables")
-            X=X[badCols] #drops all environmental variables
+            logger.info("Dropping all environmental variables")
+            #Storm variable columns are kept grouped in ENS_VARS order
+            positions=pd.unique(np.concatenate([np.flatnonzero(keep & index.part_contains('variable', [strmvar])) for strmvar in ENS_VARS]))
     if dropList:
-        print(f'Dropping {dropList}')
-        X=X.drop([colName for colName in X.columns for dropvar in dropList if dropvar in colName], axis=1)
-        
-    print(X.shape)
-    print(ts_suff)
+        logger.info(f'Dropping {dropList}')
+        #dropList entries can match any part of the name, so they are still tested against the full names
+        drop=index.contains_any(dropList)
+        keep&=~drop
+        if positions is not None:
+            positions=positions[~drop[positions]]
+    
+    X=X.iloc[:, np.flatnonzero(keep) if positions is None else positions]
+    
+    logger.info(f'Kept {X.shape[1]} of {cols_in} columns ({ts_suff})')
+    current_stage().update(rows=X.shape[0], cols_in=cols_in, cols_kept=X.shape[1])
     
     if intrastormOnly or envOnly:
         var_suff = 'intrastorm' if intrastormOnly else 'environment'
@@ -143,66 +498,545 @@ def Drop_Unwanted_Variables(X, original=False, training_scale=False, intrastormO
 
 
 
-def Simple_Random_Subsample(X_Full, y_Full, meta_full, p, seedObject=np.random.RandomState(42)):
+#Metadata columns of the ML feather files. Columns that are neither metadata nor targets (*_severe__*) are predictors
+ML_METADATA=['Run Date']
+
+def _date_groups(batches, date_col, chunk_rows):
+    #Groups a stream of record batches into lists of slices holding whole case dates and about chunk_rows rows
+    #Rows of a case date must be contiguous in the file, so a date is never split across chunks
+    pending, pending_rows=[], 0
+    done, current=set(), None
+    for batch in batches:
+        if batch.num_rows==0:
+            continue
+        dates=batch.column(date_col).to_numpy(zero_copy_only=False)
+        change=np.flatnonzero(dates[1:]!=dates[:-1])+1
+        for start, end in zip(np.r_[0, change], np.r_[change, len(dates)]):
+            date=dates[start]
+            if date!=current:
+                if date in done:
+                    raise ValueError(f'Rows for {date_col} {date} are not contiguous. Sort the file by {date_col} before streaming it')
+                if current is not None:
+                    done.add(current)
+                if pending_rows>=chunk_rows:
+                    yield pending
+                    pending, pending_rows=[], 0
+                current=date
+            pending.append(batch.slice(start, end-start))
+            pending_rows+=end-start
+    if pending:
+        yield pending
+
+def _prefetch(generator, depth):
+    #Runs generator on a background thread, keeping up to depth items ready. Exceptions are re-raised in the consumer
+    queue=Queue(maxsize=depth)
+    stop=threading.Event()
+    done=object()
+    
+    def produce():
+        try:
+            for item in generator:
+                while not stop.is_set():
+                    try:
+                        queue.put((item, None), timeout=0.1)
+                        break
+                    except Full:
+                        pass
+                if stop.is_set():
+                    return
+            queue.put((done, None))
+        except BaseException as err:
+            queue.put((done, err))
+    
+    thread=threading.Thread(target=produce, name='Stream_All_Severe prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, err=queue.get()
+            if err is not None:
+                raise err
+            if item is done:
+                return
+            yield item
+    finally:
+        #Stops the producer if the consumer stops early
+        stop.set()
+        while thread.is_alive():
+            try:
+                queue.get_nowait()
+            except Empty:
+                thread.join(0.1)
+
+def Stream_All_Severe(data_files, target_scale=36, hazards=HAZARDS, SigSevere=False, chunk_rows=500000, drop_kwargs=None,
+                      date_col='Run Date', metadata_cols=ML_METADATA, prefetch=1):
+    '''Streams (X, y, metadata) chunks of whole case dates from ML feather files, for out-of-core training (e.g. partial_fit)'''
+    '''data_files: Path like, or list of paths. Feather files of the same layout, e.g. the file load_ml_data reads for a mode/TIMESCALE
+    target_scale, hazards, SigSevere: as in All_Severe. The hazard targets are combined into one all-severe target per chunk
+    chunk_rows: int. Rows are accumulated until a chunk holds at least this many, then the chunk is closed at the next case date
+    drop_kwargs: dict of Drop_Unwanted_Variables arguments (original, training_scale, ...). The selection is worked out once from the
+                 file schema, and only the selected predictors are read. None keeps every predictor
+    date_col: str. Case date column that chunks are grouped by. Rows of each date must be contiguous in the files
+    metadata_cols: list. Metadata columns returned with each chunk
+    prefetch: int. Number of chunks read ahead on a background thread. 0 reads in the calling thread'''
+    
+    '''Peak memory depends on chunk_rows (plus the prefetched chunks), not on the size of the files'''
+    '''Yields X, y, metadata as returned by All_Severe, for one group of case dates at a time'''
+    data_files=[data_files] if isinstance(data_files, (str, os.PathLike)) else list(data_files)
+    target_cols=[hazard_target_col(hazard, target_scale, SigSevere) for hazard in hazards]
+    
+    schema=pads.dataset(data_files[0], format='feather').schema
+    predictors=[name for name in schema.names if name not in metadata_cols and '_severe__' not in name]
+    if drop_kwargs is not None:
+        #Drop_Unwanted_Variables only looks at the columns, so it runs on an empty frame with the file's predictors
+        predictors=list(Drop_Unwanted_Variables(pd.DataFrame(columns=predictors), **drop_kwargs)[0].columns)
+    columns=list(dict.fromkeys(predictors+target_cols+list(metadata_cols)+[date_col]))
+    logger.info(f'Streaming {len(predictors)} predictors from {len(data_files)} files in chunks of ~{chunk_rows} rows')
+    
+    def chunks():
+        for path in data_files:
+            batches=pads.dataset(path, format='feather').to_batches(columns=columns)
+            for group in _date_groups(batches, date_col, chunk_rows):
+                with stage('Stream_All_Severe.chunk', path=str(path)) as s:
+                    df=pa.Table.from_batches(group).to_pandas()
+                    y=np.zeros(len(df), dtype=df[target_cols[0]].dtype)
+                    for col in target_cols:
+                        y+=df[col].to_numpy()
+                    y[y>0]=1 #All target points (y>1) are remapped to y=1
+                    X=df[predictors]
+                    s.update(rows=X.shape[0], cols=X.shape[1], bytes_read=_frame_bytes(df))
+                yield X, y, df[list(metadata_cols)]
+    
+    yield from (_prefetch(chunks(), prefetch) if prefetch else chunks())
+
+
+def sweep_grid(**options):
+    '''Returns the grid of Train_Ml_Parser configurations (dicts of parser dests) for every combination of options'''
+    '''e.g. sweep_grid(training_scale=['9','27','45'], environmental=[False, True], hazard_name=[['hail'], ['wind','hail','tornado']])'''
+    keys=list(options)
+    grid=[{}]
+    for key in keys:
+        grid=[dict(config, **{key: value}) for config in grid for value in options[key]]
+    return grid
+
+def _parse_sweep_config(parser, config):
+    #A config is either a list of command line arguments or a dict of parser dests
+    if isinstance(config, dict):
+        args=parser.parse_args([])
+        unknown=set(config)-set(vars(args))
+        if unknown:
+            raise ValueError(f'Unknown Train_Ml_Parser options: {sorted(unknown)}')
+        for key, value in config.items():
+            setattr(args, key, value)
+        return args
+    return parser.parse_args([str(arg) for arg in config])
+
+def _sweep_hazards(args):
+    return [hazard.lower() for hazard in (args.hazard_name or HAZARDS)]
+
+def _sweep_target_cols(args):
+    scale=args.hazard_scale or 36
+    if str(scale)=='all':
+        raise ValueError('The sweep runner needs one hazard_scale per configuration (9, 18, or 36)')
+    return [hazard_target_col(hazard, scale, args.SigSevere) for hazard in _sweep_hazards(args)]
+
+def describe_run(X, y, metadata, args):
+    '''Default sweep run function: returns the shape and base rate of the run's dataset'''
+    return {'rows':X.shape[0], 'base_rate':float(np.mean(y)) if len(y) else float('nan')}
+
+def _shared_array(shape, dtype, order='C'):
+    shm=shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape))*np.dtype(dtype).itemsize))
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf, order=order)
+
+_sweep=None
+
+def _init_sweep_worker(X_spec, y_spec, columns, target_cols, metadata, run_fn):
+    #Process pool initializer: attaches the shared predictor and target arrays once per worker
+    global _sweep
+    arrays=[]
+    for name, shape, dtype, order in (X_spec, y_spec):
+        shm=shared_memory.SharedMemory(name=name)
+        arrays.append((shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf, order=order)))
+    _sweep={'X':arrays[0][1], 'targets':arrays[1][1], 'shm':[shm for shm, _ in arrays], 'columns':columns,
+            'target_cols':target_cols, 'metadata':metadata, 'run_fn':run_fn}
+
+def _sweep_worker(run, config, args, positions, target_positions, ts_suff, var_suff):
+    #Runs one configuration on column views of the shared arrays. Returns the summary row for the run
+    t0=time.perf_counter()
+    row={'run':run, 'config':json.dumps(config if isinstance(config, dict) else list(config), default=str),
+         'ts_suff':ts_suff, 'var_suff':var_suff, 'cols':len(positions)}
+    try:
+        X_shared=_sweep['X']
+        #Columns of the Fortran ordered array are contiguous, so each predictor is a view and nothing is copied
+        X=pd.DataFrame({_sweep['columns'][j]: X_shared[:, j] for j in positions}, copy=False)
+        y=np.zeros(X_shared.shape[0], dtype=np.uint8)
+        for j in target_positions:
+            y|=_sweep['targets'][:, j]>0
+        row['select_s']=time.perf_counter()-t0
+        t1=time.perf_counter()
+        result=_sweep['run_fn'](X, y, _sweep['metadata'], args)
+        row['run_s']=time.perf_counter()-t1
+        row.update(result or {})
+        row['status']='ok'
+    except Exception as err:
+        logger.exception(f'Sweep run {run} failed')
+        row['status']=f'error: {err!r}'
+    row['total_s']=time.perf_counter()-t0
+    return row
+
+@instrumented('Run_Sweep')
+def Run_Sweep(base_path, configs, run_fn=describe_run, summary_path=None, mode='train', FRAMEWORK='POTVIN', TIMESCALE='2to6',
+              full_9km=True, appendUH=False, Three_km=False, data_file=None, n_jobs=4, mp_context=None):
+    '''Runs a grid of Train_Ml_Parser configurations against one loaded copy of the dataset'''
+    '''base_path, mode, FRAMEWORK, TIMESCALE, full_9km, appendUH, Three_km, data_file: as in Load_Hazards. The predictors are loaded once,
+                  and every target column any configuration needs is loaded once (read from data_file with column projection if given)
+    configs: list of configurations, each a list of Train_Ml_Parser arguments (e.g. ['-ts','27','-hn','hail','wind']) or a dict of
+             parser dests (see sweep_grid)
+    run_fn: picklable function run_fn(X, y, metadata, args) -> dict of results, e.g. fits and scores a model. args is the parsed configuration.
+            X holds the configuration's Drop_Unwanted_Variables columns; y is the all-severe target of its hazard_name list
+    summary_path: Path like. If given, the summary is written to this CSV file
+    n_jobs: int. Number of worker processes
+    mp_context: multiprocessing context (e.g. multiprocessing.get_context('spawn')) for the pool. The platform default by default'''
+    
+    '''The predictors (as float32) and targets are copied once into shared memory, and the workers attach to it. Each run builds its
+    columns as views of the shared array, so no run copies the dataset'''
+    '''Returns a dataframe with one row per run: configuration, columns kept, timing (select_s, run_s, total_s), status, and run_fn results'''
+    parser=Train_Ml_Parser()
+    parsed=[_parse_sweep_config(parser, config) for config in configs]
+    target_cols=list(dict.fromkeys(col for args in parsed for col in _sweep_target_cols(args)))
+    
+    #Load once: predictors with the first target, then every other target column
+    with stage('load_ml_data', target_col=target_cols[0]):
+        X, y, metadata=load_ml_data(base_path=base_path, mode=mode, target_col=target_cols[0], FRAMEWORK=FRAMEWORK,
+                                    TIMESCALE=TIMESCALE, appendUH=appendUH, Three_km=Three_km, full_9km=full_9km)
+    targets={target_cols[0]: np.asarray(y)}
+    if len(target_cols)>1 and data_file is not None:
+        targets.update(load_ml_targets(data_file, target_cols[1:]))
+    else:
+        for col in target_cols[1:]:
+            with stage('load_ml_data', target_col=col):
+                targets[col]=np.asarray(load_ml_data(base_path=base_path, mode=mode, target_col=col, FRAMEWORK=FRAMEWORK,
+                                                     TIMESCALE=TIMESCALE, Three_km=Three_km, full_9km=full_9km)[1])
+    
+    #Column selections only depend on the column names, so they are worked out here from one PredictorIndex
+    index=predictor_index(X.columns)
+    empty=pd.DataFrame(columns=X.columns)
+    position={col: j for j, col in enumerate(X.columns)}
+    runs=[]
+    for run, (config, args) in enumerate(zip(configs, parsed)):
+        X_sel, ts_suff, var_suff=Drop_Unwanted_Variables(empty, original=args.original, training_scale=args.training_scale,
+                                                          intrastormOnly=args.intrastorm, envOnly=args.environmental, index=index)
+        runs.append((run, config, args, [position[col] for col in X_sel.columns],
+                     [target_cols.index(col) for col in _sweep_target_cols(args)], ts_suff, var_suff))
+    
+    X_shm, X_shared=_shared_array(X.shape, np.float32, order='F')
+    y_shm, y_shared=_shared_array((len(X), len(target_cols)), np.uint8)
+    try:
+        with stage('Run_Sweep.share', rows=X.shape[0], cols=X.shape[1]):
+            for j, col in enumerate(X.columns):
+                X_shared[:, j]=X[col].to_numpy()
+            for j, col in enumerate(target_cols):
+                y_shared[:, j]=targets[col]
+            columns=list(X.columns)
+            del X, y, targets
+        
+        initargs=((X_shm.name, X_shared.shape, X_shared.dtype, 'F'), (y_shm.name, y_shared.shape, y_shared.dtype, 'C'),
+                  columns, target_cols, metadata, run_fn)
+        logger.info(f'Running {len(runs)} configurations on {n_jobs} processes')
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context, initializer=_init_sweep_worker, initargs=initargs) as pool:
+            rows=list(pool.map(_sweep_worker, *zip(*runs)))
+    finally:
+        X_shm.close()
+        X_shm.unlink()
+        y_shm.close()
+        y_shm.unlink()
+    
+    summary=pd.DataFrame(rows)
+    if summary_path is not None:
+        summary.to_csv(summary_path, index=False)
+        logger.info(f'Wrote the sweep summary to {summary_path}')
+    current_stage().update(runs=len(runs), failed=int((summary['status']!='ok').sum()))
+    return summary
+
+
+def _stratum_counts(counts, p, seedObject):
+    #Number of points to keep from each stratum. Each stratum keeps floor(p*count) or one more, rounded up with probability equal to
+    #the fractional part (systematic rounding of the cumulative quotas with one random offset). Every stratum keeps p*count points in
+    #expectation, so rare strata (e.g. positives on one case date) are not rounded away, and the total is within one of p*n
+    quotas=np.cumsum(p*counts)
+    offset=seedObject.random_sample()
+    return np.diff(np.floor(np.concatenate([[0.], quotas])+offset)).astype(np.int64)
+
+def _stratified_choice(strata, p, seedObject):
+    '''Returns sorted indices of a random sample of about p*count points from each stratum (see _stratum_counts)'''
+    '''strata: array of integer stratum labels (0..n_strata-1) for every point'''
+    n=len(strata)
+    if n==0:
+        return np.array([], dtype=np.int64)
+    #Shuffle within strata by sorting on (stratum, random key), then keep the first points of each stratum
+    order=np.lexsort((seedObject.random_sample(n), strata))
+    counts=np.bincount(strata)
+    starts=np.concatenate([[0], np.cumsum(counts)[:-1]])
+    sorted_strata=strata[order]
+    rank=np.arange(n)-starts[sorted_strata]
+    keep=rank<_stratum_counts(counts, p, seedObject)[sorted_strata]
+    return np.sort(order[keep])
+
+def subsample_indices(y, p, seedObject=np.random.RandomState(42), strata=None, neg_ratio=None):
+    '''Returns the indices of a random subsample of p% of the points'''
+    '''y: array. Target values (0,1)
+    p: float. Fraction of points to keep, between (0,1]
+    seedObject: a random state object from numpy.random to allow reproducibility
+    strata: array. Integer stratum label for each point. If given, p% of each stratum is kept (in expectation; counts are rounded at random)
+    neg_ratio: float. If given, negative points (y==0) are downsampled to neg_ratio negatives per kept positive'''
+    n=len(y)
+    if strata is None and neg_ratio is None:
+        return seedObject.choice(n, int(p*n), replace=False) #Uniform sample, as drawn by Simple_Random_Subsample
+    
+    strata=np.zeros(n, dtype=np.int64) if strata is None else pd.factorize(strata)[0]
+    if neg_ratio is None:
+        return _stratified_choice(strata, p, seedObject)
+    
+    pos=np.asarray(y)>0
+    pos_inds=np.flatnonzero(pos)
+    neg_inds=np.flatnonzero(~pos)
+    pos_inds=pos_inds[_stratified_choice(pd.factorize(strata[pos_inds])[0], p, seedObject)]
+    p_neg=min(1., neg_ratio*len(pos_inds)/max(len(neg_inds), 1))
+    neg_inds=neg_inds[_stratified_choice(pd.factorize(strata[neg_inds])[0], p_neg, seedObject)]
+    return np.sort(np.concatenate([pos_inds, neg_inds]))
+
+@instrumented('Simple_Random_Subsample')
+def Simple_Random_Subsample(X_Full, y_Full, meta_full, p, seedObject=np.random.RandomState(42), stratify=None, neg_ratio=None, return_indices=False):
     '''Returns a random subsample of X_full and associated targets consisting of p% of the full training dataset'''
     
     '''X_Full: dataframe. The dataframe to draw the random sample from.'''
     '''y_Full: array. The array of target values (0,1) for X_full'''
     '''p: float. The fraction of the dataset to keep in the subsample. Must be between (0,1]'''
     '''seedObject: a random state object from numpy.random to allow reproducibility'''
+    '''stratify: str or list. Sample p% within each stratum. Entries can be 'class' (the target) or columns of meta_full, e.g. Run Date'''
+    '''neg_ratio: float. Downsample negatives to neg_ratio negatives for each kept positive'''
+    '''return_indices: Bool. If true, only the row indices are returned, so no copies of X or the metadata are made'''
     
     '''Return values:
     X_sub: subsampled dataframe of predictors
     y_sub: subsampled array of target values'''
     
     if p <=0 or p>1:
-        print('p must be a value between (0,1]')
+        logger.error('p must be a value between (0,1]')
         return None
-    elif p==1:
-        print(f'Base rate of y_full: {np.mean(y_Full)}')
+    elif p==1 and stratify is None and neg_ratio is None:
+        logger.info(f'Base rate of y_full: {np.mean(y_Full)}')
+        if return_indices:
+            return np.arange(X_Full.shape[0])
         return X_Full, y_Full, meta_full
     else:
-        n_samps=int(p*X_Full.shape[0]) #number of samples to choose
-        inds=seedObject.choice(X_Full.shape[0], n_samps, replace=False) #Indices of  subsample
+        strata=None
+        if stratify is not None:
+            stratify=[stratify] if isinstance(stratify, str) else stratify
+            keys=[np.asarray(y_Full) if key=='class' else meta_full[key].to_numpy() for key in stratify]
+            strata=pd.MultiIndex.from_arrays(keys).factorize()[0] if len(keys)>1 else pd.factorize(keys[0])[0]
+        inds=subsample_indices(y_Full, p, seedObject, strata=strata, neg_ratio=neg_ratio) #Indices of  subsample
+        y_sub=y_Full[inds]
+        
+        logger.info(f'Base rate of y_full: {np.mean(y_Full)}')
+        logger.info(f'Base rate of subsample for {p*100}%: {np.mean(y_sub)}')
+        current_stage().update(rows_in=len(y_Full), rows_kept=len(inds), base_rate_full=float(np.mean(y_Full)), base_rate_sub=float(np.mean(y_sub)))
+        if return_indices:
+            return inds
+        
         X_sub=X_Full.iloc[inds]
         X_sub.reset_index(drop=True, inplace=True)
-        y_sub=y_Full[inds]
         meta_sub=meta_full.iloc[inds]
         meta_sub.reset_index(drop=True, inplace=True) #Keep an eye on this to see if it breaks
         
-        print(f'Base rate of y_full: {np.mean(y_Full)}')
-        print(f'Base rate of subsample for {p*100}%: {np.mean(y_sub)}')
-        
         return X_sub, y_sub, meta_sub
+
+def _concat_rows(frames):
+    #Concatenates row subsets of frames with the same columns. Categorical columns stay categorical, with the union of the categories
+    out=pd.concat(frames, ignore_index=True)
+    for col in frames[0].columns:
+        dtypes=[frame[col].dtype for frame in frames]
+        if all(isinstance(dtype, pd.CategoricalDtype) for dtype in dtypes) and not isinstance(out[col].dtype, pd.CategoricalDtype):
+            categories=pd.api.types.union_categoricals([frame[col] for frame in frames]).categories
+            out[col]=out[col].astype(pd.CategoricalDtype(categories))
+    return out
+
+def _take_slots(parts, slot_part, slot_row):
+    #Builds the frame whose row i is row slot_row[i] of parts[slot_part[i]], with one iloc per part and one concat
+    used=np.unique(slot_part)
+    order=[np.flatnonzero(slot_part==p) for p in used]
+    frame=_concat_rows([parts[p].iloc[slot_row[rows]] for p, rows in zip(used, order)])
+    return frame.iloc[np.argsort(np.concatenate(order), kind='stable')].reset_index(drop=True)
+
+@instrumented('Reservoir_Subsample')
+def Reservoir_Subsample(chunks, n_samps, seedObject=np.random.RandomState(42)):
+    '''Returns a uniform random subsample of n_samps points from data that arrives in chunks, without holding more than one chunk'''
+    '''chunks: iterable of (X, y, metadata) chunks, e.g. read from disk one case date at a time
+    n_samps: int. Number of points to keep
+    seedObject: a random state object from numpy.random to allow reproducibility'''
+    
+    '''Return values are as in Simple_Random_Subsample. Column dtypes (including categorical metadata) are kept'''
+    #Each slot records which kept part and row it holds. Only the rows that entered the reservoir are kept from each chunk,
+    #and X/metadata are built with iloc and concat, so rows are never written through a common dtype
+    X_parts, meta_parts=[], []
+    slot_part=np.zeros(0, dtype=np.int64)
+    slot_row=np.zeros(0, dtype=np.int64)
+    y_res=None
+    seen=0
+    for X, y, meta in chunks:
+        y=np.asarray(y)
+        t=seen+np.arange(len(y)) #Position of each point in the full stream
+        seen+=len(y)
+        
+        #Algorithm R: point t fills slot t while the reservoir is filling, then replaces slot j~U[0,t] if j<n_samps
+        slots=np.where(t<n_samps, t, np.floor(seedObject.random_sample(len(t))*(t+1)).astype(np.int64))
+        valid=np.flatnonzero(slots<n_samps)
+        #Later points overwrite earlier ones in the same slot, so keep the last write to each slot
+        last=valid[::-1][np.unique(slots[valid[::-1]], return_index=True)[1]]
+        if not len(last):
+            continue
+        dst=slots[last]
+        
+        size=max(len(slot_part), int(dst.max())+1)
+        if size>len(slot_part):
+            slot_part=np.concatenate([slot_part, np.zeros(size-len(slot_part), dtype=np.int64)])
+            slot_row=np.concatenate([slot_row, np.zeros(size-len(slot_row), dtype=np.int64)])
+            y_res=y[:0].copy() if y_res is None else y_res
+            y_res=np.concatenate([y_res, np.zeros(size-len(y_res), dtype=y_res.dtype)])
+        X_parts.append(X.iloc[last])
+        meta_parts.append(meta.iloc[last])
+        slot_part[dst]=len(X_parts)-1
+        slot_row[dst]=np.arange(len(last))
+        y_res[dst]=y[last]
+        
+        #Drops replaced rows once the kept parts hold twice the reservoir, so memory stays bounded by n_samps
+        if sum(len(part) for part in X_parts)>2*len(slot_part):
+            X_parts=[_take_slots(X_parts, slot_part, slot_row)]
+            meta_parts=[_take_slots(meta_parts, slot_part, slot_row)]
+            slot_part[:]=0
+            slot_row=np.arange(len(slot_part))
     
-def group_coefs(Cols, coefs, groupby=None):
+    if y_res is None:
+        X_res=meta_res=None
+    else:
+        X_res=_take_slots(X_parts, slot_part, slot_row)
+        meta_res=_take_slots(meta_parts, slot_part, slot_row)
+    logger.info(f'Kept {0 if y_res is None else len(y_res)} of {seen} points')
+    current_stage().update(rows_in=seen, rows_kept=0 if y_res is None else len(y_res))
+    return X_res, y_res, meta_res
+    
+def group_coefs(Cols, coefs, groupby=None, agg='sum', stats=('mean','std','min','median','max')):
     '''Takes in a list of column names, and the matching coefficients for LR, and returns a DF that can be grouped'''
     '''Cols- list of variable names
-    coefs - coefficients from LR corresponding to the columns
+    coefs - coefficients from LR corresponding to the columns. Either one vector, or a 2D stack of (models x features), e.g. from bootstrapped models
+    groupby - part(s) of the names to group by: variable, category, neighborhood, statistic
+    agg - for a 2D stack, how each model's coefficients are combined within a group
+    stats - for a 2D stack, summary statistics computed across the models. Names of numpy reductions, e.g. mean, std, median
     '''
-    X=pd.DataFrame(columns=['name','variable','category','neighborhood','statistic', 'coef']) #Make an empty dataframe
-    X['name']=Cols #'name' contains the unparsed variable names from the ml df
-    X['coef']=np.abs(coefs) #Absolute value of coefs
-    X['variable']=[var.split('__')[0] for var in Cols]
-    X['category']=[var.split('__')[1] if 'Init Time' not in var else 'time_avg' for var in Cols]
-    X['neighborhood']=[var.split('__')[2] if 'Init Time' not in var else '4km'for var in Cols]
-    X['statistic']=[var.split('__')[3]if 'Init Time' not in var else 'N/A' for var in Cols]
-    X=X.drop('name', axis=1)
+    '''Returns:
+    1D coefs: a dataframe of the name parts and the absolute coefficients, or its groupby object if groupby is given.
+              Parts missing from names with fewer than four parts are NaN (the original raised an IndexError for them)
+    2D coefs: a dataframe of the name parts with the stats of the absolute coefficients across models.
+              If groupby is given, one row per group with the stats of each model's agg of the group'''
+    X=parse_predictor_names(Cols) #Categorical columns of the name parts
+    coefs=np.abs(np.asarray(coefs)) #Absolute value of coefs
+    
+    if coefs.ndim==1:
+        #Plain string columns, as before, so reductions over the groups (e.g. .sum()) work on every column. Missing parts stay NaN, not 'nan'
+        X=X.astype(str).where(X.notna())
+        X['coef']=coefs
+        if groupby is None:
+            return X
+        else:
+            return X.groupby(by=groupby)
+    
+    if coefs.shape[1]!=len(X):
+        raise ValueError(f'coefs has {coefs.shape[1]} features, but {len(X)} column names were given')
     if groupby is None:
-        return X
+        per_model=pd.DataFrame(coefs.T)
+        index=X
     else:
-        return X.groupby(by=groupby)
+        #Per-model group aggregates for all models at once: (groups x models)
+        per_model=pd.DataFrame(coefs.T).groupby([X[part] for part in np.atleast_1d(groupby)], observed=True).agg(agg)
+        index=None
+    values=per_model.to_numpy()
+    summary=pd.DataFrame({f'coef_{stat}': getattr(np, stat)(values, axis=1) for stat in stats}, index=per_model.index)
+    if index is not None:
+        summary=pd.concat([index, summary], axis=1)
+    return summary
     
     
-def pseudo_all_severe_probs(models, X_test):
+def _log_no_severe(models, X_chunk):
+    '''Returns sum over models of log(1-p), the log probability that none of the hazards occur, for each row of X_chunk'''
+    log_no_severe=np.zeros(X_chunk.shape[0], dtype=np.float64)
+    for model in models:
+        log_no_severe+=np.log1p(-model[1].predict_proba(X_chunk)[:,1])
+    return log_no_severe
+
+_worker_models=None
+
+def _init_inference_worker(models):
+    '''Process pool initializer, so the models are sent to each worker once instead of with every chunk'''
+    global _worker_models
+    _worker_models=models
+
+def _log_no_severe_worker(X_chunk):
+    return _log_no_severe(_worker_models, X_chunk)
+
+@instrumented('pseudo_all_severe_probs')
+def pseudo_all_severe_probs(models, X_test, chunk_size=None, n_jobs=1, executor='thread', dtype=np.float32, out=None):
     '''Takes in a list of models trained on individual hazards, then predicts on X_test to produce probability of any severe hazard'''
     '''models - list of models, where each model is trained for an individual severe weather hazard'''
-    '''X_test - data to generate predictions for'''   
-    indiv_probs=[model[1].predict_proba(X_test)[:,1] for model in models] #List of probabilities that a given hazard occurs
-    no_severe_probs=np.ones_like(indiv_probs)-indiv_probs #List of probabilities that a given hazard doesn't occur
-    no_severe_probs=np.multiply.reduce(no_severe_probs, axis=0) #Multiplies all probabilites together at a given grid point - probability that none of the severe hazards occur at that point
-    all_severe_probs=np.ones_like(no_severe_probs)-no_severe_probs #Complementary - (1-prob of no hazards)=prob of any (or all) hazards
-    return all_severe_probs
+    '''X_test - data to generate predictions for'''
+    '''chunk_size - number of rows predicted at a time. By default X_test is predicted in one chunk'''
+    '''n_jobs - number of chunks predicted concurrently'''
+    '''executor - 'thread' or 'process'. Threads suit models that release the GIL; processes receive the models once when they start'''
+    '''dtype - dtype of the returned probabilities'''
+    '''out - optional preallocated array of length len(X_test) to write the probabilities into'''
+    
+    #P(any hazard) = 1 - prod(1-p_i) = -expm1(sum(log1p(-p_i))), accumulated per chunk so only one chunk of probabilities is held per worker
+    n_rows=X_test.shape[0]
+    chunk_size=n_rows if not chunk_size else int(chunk_size)
+    if out is None:
+        out=np.empty(n_rows, dtype=dtype)
+    starts=range(0, n_rows, max(chunk_size, 1))
+    
+    def _chunk(start):
+        return X_test.iloc[start:start+chunk_size] if hasattr(X_test, 'iloc') else X_test[start:start+chunk_size]
+    
+    def _store(start, log_no_severe):
+        dest=out[start:start+chunk_size]
+        np.expm1(log_no_severe, out=log_no_severe)
+        np.negative(log_no_severe, out=dest, casting='same_kind')
+    
+    t0=time.perf_counter()
+    if n_jobs==1:
+        for start in starts:
+            _store(start, _log_no_severe(models, _chunk(start)))
+    else:
+        if executor=='thread':
+            pool=ThreadPoolExecutor(max_workers=n_jobs)
+            submit=lambda start: pool.submit(_log_no_severe, models, _chunk(start))
+        elif executor=='process':
+            pool=ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_inference_worker, initargs=(models,))
+            submit=lambda start: pool.submit(_log_no_severe_worker, _chunk(start))
+        else:
+            raise ValueError(f"executor must be 'thread' or 'process', got {executor}")
+        with pool:
+            #At most 2*n_jobs chunks are in flight, so memory does not grow with the size of X_test
+            pending={}
+            for start in starts:
+                pending[submit(start)]=start
+                if len(pending)>=2*n_jobs:
+                    done=next(as_completed(pending))
+                    _store(pending.pop(done), done.result())
+            for done in as_completed(pending):
+                _store(pending[done], done.result())
+    elapsed=time.perf_counter()-t0
+    rows_per_s=n_rows/max(elapsed, 1e-9)
+    logger.info(f'Predicted {n_rows} rows with {len(models)} models in {elapsed:.2f} s ({rows_per_s:.0f} rows/s)')
+    current_stage().update(rows=n_rows, models=len(models), rows_per_s=rows_per_s)
+    
+    return out
 
 def get_bl_col(target_scale, hazard_name, timescale):
     '''Returns the correct baseline column title for the given timescale, hazard, and target_scale'''
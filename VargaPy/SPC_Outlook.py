@@ -2,13 +2,38 @@
 #import json
 import os
 from os.path import exists, join
-import urllib.request
-from zipfile import ZipFile
+from zipfile import ZipFile, BadZipFile
+from urllib.parse import urljoin
 #import shapefile
 #from descartes import PolygonPatch
-import geopandas as gpd
-import matplotlib.patches as mpatches
-from bs4 import BeautifulSoup
+import numpy as np
+import hashlib
+import json
+import re
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+import logging
+from datetime import datetime, timedelta
+from VargaPy.Instrumentation import stage
+from VargaPy.Downloads import fetch, fetch_many
+from VargaPy.LazyImport import LazyModule
+
+#Heavy dependencies are imported the first time they are used
+gpd=LazyModule('geopandas')
+pd=LazyModule('pandas')
+shapely=LazyModule('shapely')
+mpatches=LazyModule('matplotlib.patches')
+mpath=LazyModule('matplotlib.path')
+mcollections=LazyModule('matplotlib.collections')
+bs4=LazyModule('bs4')
+
+OUTLOOK_ARCHIVE_URL='https://www.spc.noaa.gov/products/outlook/archive'
+OUTLOOK_CATEGORIES=['cat','wind','hail','torn']
+#Yearly catalogs of mesoscale discussions and watches. Files are listed at {url}/YYYY/
+PRODUCT_URLS={'md':'https://www.spc.noaa.gov/products/md', 'watch':'https://www.spc.noaa.gov/products/watch'}
+SPC_PRODUCTS=list(PRODUCT_URLS)
+
+logger=logging.getLogger(__name__)
 
 class SPCoutlook: 
     '''Class for acessing SPC Convective Outlooks'''
@@ -21,10 +46,14 @@ class SPCoutlook:
     filename: can specify a filename to request from URL. By default, the zipped shapefiles are requested.
     local_filename: can specify a local filename to load. By default, the shapefiles for the given category are loaded. 
     extract: If true, the zipped shapefiles are automatically unzipped when downloaded.
+    store_path: can specify an outlook store written by ingest_outlooks to load from instead of the shapefiles.
+    outlook: can specify an already loaded outlook GeoDataFrame (DN, geometry), e.g. from load_outlooks. Nothing is read from disk.
+    
+    The outlook is downloaded/loaded the first time the outlook attribute is used, not when the instance is created.
     '''
     
-    def __init__(self, date, category, base_path, outlook_time='1630', url='https://www.spc.noaa.gov/products/outlook/archive',
-                 filename=None, local_filename=None, extract=True):
+    def __init__(self, date, category, base_path, outlook_time='1630', url=OUTLOOK_ARCHIVE_URL,
+                 filename=None, local_filename=None, extract=True, store_path=None, outlook=None):
         self.date = date
         self.category = category
         self.base_path = join(base_path, date)
@@ -34,6 +63,9 @@ class SPCoutlook:
         #self.filename = filename if filename else f'day1otlk_{date}_1630.kmz'
         self.local_filename=local_filename if local_filename else '_'.join(self.filename.split('_')[0:-1])+f'_1630_{self.category}.shp'
         self.extract = extract
+        self.store_path = store_path
+        self._projected = {} #Reprojected geometry for each CRS
+        self._paths = {} #Plotting paths for each CRS
         self.colors = {'cat':{2:('TSTM','#c1e9c1') , 3:('MRGL','#80c580') , 4:('SLGT','#f7f780') , 5:('ENH','#e6c280') , 6:('MDT','#e68080') , 8:('HIGH','#ff80ff')},
                         'wind':{5:('5','#8b4726'), 15:('15','#ffc800'), 30:('30','#ff0000'), 45:('45','#ff00ff'), 60:('60','#912cee'), 10:('10% Sig','k')},
                         'hail':{5:('5','#8b4726'), 15:('15','#ffc800'), 30:('30','#ff0000'), 45:('45','#ff00ff'), 60:('60','#912cee'), 10:('10% Sig','k')},
@@ -43,26 +75,37 @@ class SPCoutlook:
                               'wind':'SPC Wind Probability Legend (in %)',
                               'torn':'SPC Tornado Probability Legend (in %)'}
         
-        #Download & Load SPC outlook files when class instance is created
-        self.load_spc_outlook()
+        #SPC outlook files are downloaded & loaded the first time self.outlook is used
+        self._outlook = outlook.sort_values(by='DN') if outlook is not None else None
+    
+    @property
+    def outlook(self):
+        '''GeoDataFrame of the outlook polygons sorted by DN. Loaded from the store or shapefiles on first access'''
+        if self._outlook is None:
+            if self.store_path is not None:
+                self._outlook = load_outlooks(self.store_path, self.date, self.date, [self.category]).sort_values(by='DN')
+            else:
+                self.load_spc_outlook()
+        return self._outlook
+    
+    @outlook.setter
+    def outlook(self, outlook):
+        self._outlook = outlook
+        self._projected = {}
+        self._paths = {}
         
     def download_spc_outlook(self):
         '''Downloads the shapefiles for a given date from the SPC archive, then unzips them'''
     
-        #directory doesn't exist:
-        if not exists(self.base_path): 
-            #make directory
-            print(f'Making {self.base_path}')
-            os.mkdir(self.base_path)
-
-        #Download file
-        print(f'Downloading outlook from {join(self.url, f"{self.date[0:4]}/{self.filename}")}')
-        urllib.request.urlretrieve(join(self.url, f'{self.date[0:4]}/{self.filename}'), join(self.base_path, self.filename))
+        #Download file. fetch creates any missing directories and writes the file atomically
+        logger.info(f'Downloading outlook from {self.url}/{self.date[0:4]}/{self.filename}')
+        with stage('SPCoutlook.download', date=self.date) as s:
+            s.update(bytes_read=fetch(f'{self.url}/{self.date[0:4]}/{self.filename}', join(self.base_path, self.filename)))
         
 
         #Extract files    
         if self.extract: 
-            print(f'Extracting {self.filename} in {self.base_path}')
+            logger.info(f'Extracting {self.filename} in {self.base_path}')
             with ZipFile(join(self.base_path, self.filename)) as ZF:
                 ZF.extractall(self.base_path)
         return 
@@ -74,65 +117,71 @@ class SPCoutlook:
         if not exists(join(self.base_path, self.filename)):
             self.download_spc_outlook()
         else:
-            print('Outlook file already exists locally')
+            logger.debug('Outlook file already exists locally')
 
         #Load outlook shapefile
-        print(f'Loading {self.local_filename}')
+        logger.info(f'Loading {self.local_filename}')
         
         #Saves and sorts the values in order based on label
-        self.outlook = gpd.read_file(join(self.base_path, self.local_filename)).sort_values(by='DN')  
-        print(self.outlook)
-        print(guidance for guidance in self.outlook.geometry)
-        print(self.outlook.crs)
+        with stage('SPCoutlook.load', date=self.date, category=self.category) as s:
+            self.outlook = gpd.read_file(join(self.base_path, self.local_filename)).sort_values(by='DN')  
+            s.update(rows=len(self.outlook), bytes_read=os.path.getsize(join(self.base_path, self.local_filename)))
+        logger.debug(f'Loaded {len(self.outlook)} {self.category} polygons (DN {list(self.outlook.DN)}) in {self.outlook.crs}')
         return 
     
     
-    #######
-    """
-    def download_watches_and_discussions(self, url=f'https://www.spc.noaa.gov/products/md/{self.date[0:4]/}'):
-        '''Downloads the watches and mesoscale discussions from the SPC catalogue'''
-        
-        page=requests.get().text
-        soup=BeautifulSoup(page, 'html.parser')
-        files=[element.get_text() for element in soup.find_all('a') if '.kmz' in element.get_text()] #List of available files
-        
-        #File checks
-        missing_files=
-        
-        if len(missing_files)!=0:
-            print(f'Missing {} Mesoscale Discussions for {self.date[0:4]}')
-            print('Downloading')
-            
-            for file in missing_files:
-                file_url=join(url, file) #File to download
-                file_out=join(self.meso_dir, file) #Temporary Output Name
-        
-        if len(missing_files)!=0:
-            print(f'Missing {} Watches for {self.date[0:4]}')
-            
-            
-        https://www.spc.noaa.gov/products/watch/2019/
-        https://www.spc.noaa.gov/products/md/2019/
-        
-        urllib.request.urlretrieve(url, gzfile)
-                
-    #def load_contours():
-    """
+    def download_watches_and_discussions(self, products=SPC_PRODUCTS, **kwargs):
+        '''Syncs this outlook's year of watches and mesoscale discussions from the SPC catalogs into base_path/{product}/YYYY/'''
+        '''kwargs are passed to sync_spc_products. Returns the product index for the year (see load_product_index)'''
+        base_path=os.path.dirname(self.base_path)
+        sync_spc_products(self.date[0:4], base_path, products, **kwargs)
+        return load_product_index(base_path, products, [self.date[0:4]])
     
-    ######
+    
+    def rasterize(self, grid, NX=None, NY=None):
+        '''Returns the highest outlook DN enclosing each point of grid (0 outside every polygon)'''
+        '''Params:
+        grid: OutlookGrid, or a (lats, lons) tuple of 2D arrays of grid point locations
+        NX, NY: optional arrays of grid indices, e.g. the NX/NY columns of the ML metadata. If given, only those points are returned
+        '''
+        '''Sig areas (10% Sig in the legend) are not probabilities, and are ignored for wind and hail'''
+        grid=get_outlook_grid(*grid) if isinstance(grid, tuple) else grid
+        ignore=[dn for dn, (label, _) in self.colors[self.category].items() if 'Sig' in label]
+        raster=grid.rasterize(self.outlook, ignore_dn=ignore)
+        if NX is not None and NY is not None:
+            return raster[np.asarray(NY), np.asarray(NX)]
+        return raster
     
     def add_to_ax(self, ax, crs):
         '''Adds the outlook boundaries to an existing figure axis'''
         '''Params:
-        ax: figure axis to plot outlook boundaries on
-        crs: projection that data is being plotted in 
+        ax: figure axis to plot outlook boundaries on. Either a cartopy GeoAxes, or plain axes whose data coordinates are in crs
+        crs: projection that data is being plotted in. On a GeoAxes, the boundaries are drawn with transform=crs, as for any cartopy plot
         '''
-        self.outlook.geometry = self.outlook.geometry.to_crs(crs)
-
-        for poly, dn in zip(self.outlook.geometry, self.outlook.DN):
-            
-            #Polygons are ordered from high to low, but we plot from low to high so the higher risk boundaries appear on top.
-            ax.add_geometries(poly, crs=crs, facecolor='None', edgecolor=self.colors[self.category][dn][1])
+        '''Returns the PathCollection holding all of the outlook boundaries'''
+        paths=self.projected_paths(crs)
+        #Polygons are ordered from high to low, but we plot from low to high so the higher risk boundaries appear on top.
+        colors=[self.colors[self.category][dn][1] for dn in self.outlook.DN]
+        #Every polygon goes into one collection, which matplotlib draws in order
+        #A GeoAxes (which has a projection) maps paths from crs to its own projection when given transform=crs
+        transform=crs if hasattr(ax, 'projection') else ax.transData
+        collection=mcollections.PathCollection(paths, facecolors='none', edgecolors=colors, transform=transform)
+        ax.add_collection(collection, autolim=False)
+        return collection
+    
+    def projected(self, crs):
+        '''Returns the outlook geometry reprojected to crs. Reprojections are cached per CRS and self.outlook is left unchanged'''
+        key=_crs_key(crs)
+        if key not in self._projected:
+            self._projected[key]=self.outlook.geometry.to_crs(crs)
+        return self._projected[key]
+    
+    def projected_paths(self, crs):
+        '''Returns matplotlib paths of the outlook polygons in crs, cached per CRS'''
+        key=_crs_key(crs)
+        if key not in self._paths:
+            self._paths[key]=[_polygon_path(poly) for poly in self.projected(crs)]
+        return self._paths[key]
 
  
     
@@ -146,3 +195,352 @@ class SPCoutlook:
         ax.axis('off')
         
         return legend
+
+
+
+def outlook_dates(start_date, end_date):
+    '''Returns every date from start_date to end_date (inclusive) as YYYYMMDD strings'''
+    start, end=datetime.strptime(start_date, '%Y%m%d'), datetime.strptime(end_date, '%Y%m%d')
+    return [(start+timedelta(days=i)).strftime('%Y%m%d') for i in range((end-start).days+1)]
+
+def extract_outlook(zip_path, out_dir, categories=None):
+    '''Extracts the shapefiles for categories (all if None) from an outlook zip into out_dir'''
+    with ZipFile(zip_path) as ZF:
+        members=[name for name in ZF.namelist() if categories is None or any(f'_{cat}.' in name for cat in categories)]
+        ZF.extractall(out_dir, members=members)
+    return members
+
+def download_spc_outlooks(start_date, end_date, base_path, categories=OUTLOOK_CATEGORIES, outlook_time='1630', url=OUTLOOK_ARCHIVE_URL,
+                          extract=True, max_workers=8, retries=3, backoff=1.):
+    '''Downloads the outlook archive for every date in a range, laid out as SPCoutlook expects (base_path/YYYYMMDD/)'''
+    '''Params:
+    start_date, end_date: YYYYMMDD - first and last date to download
+    base_path: local directory to where outlook files are saved
+    categories: categories to extract from each zip. Dates whose zip is already on disk are not downloaded again
+    outlook_time: time when outlook was published - default is 1630
+    url: URL of the outlook archive. Files are requested from url/YYYY/day1otlk_YYYYMMDD_HHMM-shp.zip
+    extract: If true, the shapefiles for categories are extracted after download
+    max_workers: number of concurrent downloads
+    retries, backoff: retry failed downloads, waiting backoff seconds before the first retry and doubling after each
+    '''
+    '''Returns a dict of {date: path to the zip, or the exception raised for that date}. Dates missing from the archive have an HTTPError'''
+    dates=outlook_dates(start_date, end_date)
+    paths={date: join(base_path, date, f'day1otlk_{date}_{outlook_time}-shp.zip') for date in dates}
+    jobs=[(f'{url}/{date[0:4]}/{os.path.basename(paths[date])}', paths[date]) for date in dates if not exists(paths[date])]
+    logger.info(f'Downloading {len(jobs)} of {len(dates)} outlooks; {len(dates)-len(jobs)} already on disk')
+    results=fetch_many(jobs, max_workers=max_workers, retries=retries, backoff=backoff)
+    
+    out={}
+    for date in dates:
+        result=results.get(paths[date], 0)
+        if isinstance(result, Exception):
+            out[date]=result
+            continue
+        if extract:
+            stems=[join(base_path, date, f'day1otlk_{date}_{outlook_time}_{cat}.shp') for cat in categories]
+            if not all(exists(stem) for stem in stems):
+                extract_outlook(paths[date], join(base_path, date), categories)
+        out[date]=paths[date]
+    return out
+
+def _store_partition(store_path, category, year):
+    return join(store_path, f'category={category}', f'year={year}', 'outlooks.parquet')
+
+def ingest_outlooks(base_path, store_path, dates, categories=OUTLOOK_CATEGORIES, outlook_time='1630', crs='EPSG:4326'):
+    '''Converts extracted outlook shapefiles into a GeoParquet store partitioned by category and year'''
+    '''Params:
+    base_path: local directory where the outlook files are saved (base_path/YYYYMMDD/), e.g. by download_spc_outlooks
+    store_path: directory of the store. Partitions are written to store_path/category=CAT/year=YYYY/outlooks.parquet
+    dates: list of YYYYMMDD dates to ingest. Dates already in the store are replaced; dates without a shapefile are skipped
+    categories: categories to ingest
+    outlook_time: time when outlook was published - default is 1630
+    crs: all outlooks are stored in this CRS
+    '''
+    '''Returns the number of polygons written'''
+    frames={}
+    for date in dates:
+        for category in categories:
+            shp=join(base_path, date, f'day1otlk_{date}_{outlook_time}_{category}.shp')
+            if not exists(shp):
+                logger.debug(f'No {category} outlook for {date}')
+                continue
+            outlook=gpd.read_file(shp)
+            outlook=outlook.set_crs(crs) if outlook.crs is None else outlook.to_crs(crs)
+            outlook.insert(0, 'date', date)
+            frames.setdefault((category, date[0:4]), []).append(outlook)
+    
+    written=0
+    with stage('ingest_outlooks', dates=len(dates)) as s:
+        for (category, year), new in frames.items():
+            new=pd.concat(new, ignore_index=True)
+            path=_store_partition(store_path, category, year)
+            if exists(path):
+                old=gpd.read_parquet(path)
+                new=pd.concat([old[~old['date'].isin(new['date'])], new], ignore_index=True)
+            #Sorted by date so the row group statistics let date range queries skip row groups
+            new=gpd.GeoDataFrame(new.sort_values(['date', 'DN'], kind='stable').reset_index(drop=True), crs=crs)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            new.to_parquet(path+'.tmp', index=False, row_group_size=5000)
+            os.replace(path+'.tmp', path)
+            written+=len(new)
+        s.update(rows=written)
+    logger.info(f'Wrote {written} polygons for {len(frames)} category/year partitions to {store_path}')
+    return written
+
+def load_outlooks(store_path, start_date, end_date=None, categories=None, columns=None):
+    '''Loads every outlook between start_date and end_date (inclusive) from a store written by ingest_outlooks in one read'''
+    '''Params:
+    start_date, end_date: YYYYMMDD. end_date defaults to start_date
+    categories: list of categories to load. All categories by default
+    columns: list of columns to read. All columns by default
+    '''
+    '''Returns a GeoDataFrame with date and category columns, sorted by category, date, and DN'''
+    end_date=start_date if end_date is None else end_date
+    filters=[('date', '>=', start_date), ('date', '<=', end_date),
+             ('year', '>=', int(start_date[0:4])), ('year', '<=', int(end_date[0:4]))]
+    if categories is not None:
+        filters.append(('category', 'in', list(categories)))
+    if columns is not None:
+        columns=list(dict.fromkeys(['date', 'category', 'DN']+list(columns)+['geometry']))
+    with stage('load_outlooks', start_date=start_date, end_date=end_date) as s:
+        outlooks=gpd.read_parquet(store_path, columns=columns, filters=filters)
+        outlooks['category']=outlooks['category'].astype(str)
+        outlooks=outlooks.drop(columns='year', errors='ignore').sort_values(['category', 'date', 'DN'], kind='stable').reset_index(drop=True)
+        s.update(rows=len(outlooks))
+    return outlooks
+
+def load_spc_outlooks(store_path, start_date, end_date, category, base_path='.', **kwargs):
+    '''Returns a dict of {date: SPCoutlook} for every date with a category outlook in the store, from one read'''
+    '''kwargs are passed to SPCoutlook'''
+    outlooks=load_outlooks(store_path, start_date, end_date, [category])
+    return {date: SPCoutlook(date, category, base_path, outlook=outlook.reset_index(drop=True), **kwargs)
+            for date, outlook in outlooks.groupby('date', sort=True)}
+
+
+def _product_dir(base_path, product, year):
+    return join(base_path, product, str(year))
+
+def list_catalog(catalog_path, url, extension='.kmz'):
+    '''Returns {filename: url} for every link to a file ending in extension in a downloaded catalog page'''
+    with open(catalog_path, 'rb') as f:
+        soup=bs4.BeautifulSoup(f.read(), 'html.parser')
+    files={}
+    for element in soup.find_all('a', href=True):
+        href=element['href'].split('?')[0]
+        if href.lower().endswith(extension):
+            files[os.path.basename(href)]=urljoin(url.rstrip('/')+'/', href)
+    return files
+
+def read_manifest(path):
+    '''Returns the manifest of a product directory as {filename: entry}, or {} if it does not exist'''
+    if not exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def _write_manifest(path, manifest):
+    #Written to a temporary file and renamed, so an interrupted sync never leaves a truncated manifest
+    with open(path+'.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path+'.tmp', path)
+
+def kmz_valid_times(path):
+    '''Returns the (start, end) valid times of a KMZ as ISO strings, from its KML TimeSpan or TimeStamp. (None, None) if it has neither'''
+    try:
+        with ZipFile(path) as ZF:
+            kml=next(name for name in ZF.namelist() if name.lower().endswith('.kml'))
+            root=ET.fromstring(ZF.read(kml))
+    except (StopIteration, OSError, KeyError, ET.ParseError, BadZipFile) as err:
+        logger.warning(f'Could not read valid times from {path}: {err!r}')
+        return None, None
+    times={}
+    for element in root.iter():
+        tag=element.tag.rsplit('}', 1)[-1] #Strip the KML namespace
+        if tag in ('begin', 'end', 'when') and tag not in times and element.text:
+            times[tag]=element.text.strip()
+    start=times.get('begin', times.get('when'))
+    return start, times.get('end', start)
+
+def sync_spc_products(year, base_path, products=SPC_PRODUCTS, urls=PRODUCT_URLS, extension='.kmz', max_workers=8, retries=3, backoff=1.):
+    '''Incrementally syncs a year of SPC watches and/or mesoscale discussions into base_path/{product}/YYYY/'''
+    '''Params:
+    year: YYYY - year of the catalog to sync
+    base_path: local directory to where product files are saved
+    products: products to sync, any of SPC_PRODUCTS
+    urls: {product: URL of the yearly catalogs}. Catalogs are read from url/YYYY/. Can point to a local stand-in server
+    extension: files in the catalog to download
+    max_workers, retries, backoff: as in Downloads.fetch_many
+    '''
+    '''Each product directory keeps a manifest.json of the files already downloaded, with their size and valid times.
+    Only catalog files missing from the manifest (or from disk) are downloaded, so a re-run costs one catalog request per product plus any new files'''
+    '''Returns {product: {'catalog': files in the catalog, 'downloaded': files downloaded, 'failed': {filename: exception}}}'''
+    year=str(year)
+    manifests, jobs, pending={}, [], {}
+    with stage('sync_spc_products', year=year) as s:
+        for product in products:
+            directory=_product_dir(base_path, product, year)
+            url=f'{urls[product].rstrip("/")}/{year}/'
+            catalog_path=join(directory, 'catalog.html')
+            fetch(url, catalog_path, retries=retries, backoff=backoff, overwrite=True) #The catalog is always refreshed
+            catalog=list_catalog(catalog_path, url, extension)
+            manifests[product]=read_manifest(join(directory, 'manifest.json'))
+            missing={name: file_url for name, file_url in catalog.items()
+                     if name not in manifests[product] or not exists(join(directory, name))}
+            logger.info(f'{product} {year}: {len(missing)} of {len(catalog)} files to download')
+            jobs+=[(file_url, join(directory, name)) for name, file_url in missing.items()]
+            pending[product]=(catalog, missing)
+        
+        results=fetch_many(jobs, max_workers=max_workers, retries=retries, backoff=backoff, overwrite=True) if jobs else {}
+        
+        summary={}
+        for product, (catalog, missing) in pending.items():
+            directory=_product_dir(base_path, product, year)
+            manifest, failed=manifests[product], {}
+            for name, file_url in missing.items():
+                result=results[join(directory, name)]
+                if isinstance(result, Exception):
+                    failed[name]=result
+                    continue
+                valid_start, valid_end=kmz_valid_times(join(directory, name))
+                manifest[name]={'url':file_url, 'bytes':os.path.getsize(join(directory, name)), 'valid_start':valid_start, 'valid_end':valid_end}
+            _write_manifest(join(directory, 'manifest.json'), manifest)
+            summary[product]={'catalog':len(catalog), 'downloaded':len(missing)-len(failed), 'failed':failed}
+        s.update(files=len(jobs), failed=sum(len(result['failed']) for result in summary.values()))
+    return summary
+
+def load_product_index(base_path, products=SPC_PRODUCTS, years=None):
+    '''Returns an index of synced products sorted by valid time, from the manifests written by sync_spc_products'''
+    '''Params:
+    base_path: directory passed to sync_spc_products
+    products: products to include
+    years: list of YYYY years to include. Every synced year by default
+    '''
+    '''Returns a dataframe with product, year, number, file, path, valid_start and valid_end (UTC timestamps, NaT where unknown) columns'''
+    rows=[]
+    for product in products:
+        product_years=years if years is not None else sorted(os.listdir(join(base_path, product))) if exists(join(base_path, product)) else []
+        for year in product_years:
+            directory=_product_dir(base_path, product, year)
+            for name, entry in read_manifest(join(directory, 'manifest.json')).items():
+                number=re.search(r'(\d{4})', name)
+                rows.append({'product':product, 'year':str(year), 'number':int(number.group(1)) if number else None, 'file':name,
+                             'path':join(directory, name), 'valid_start':entry.get('valid_start'), 'valid_end':entry.get('valid_end')})
+    index=pd.DataFrame(rows, columns=['product', 'year', 'number', 'file', 'path', 'valid_start', 'valid_end'])
+    for col in ('valid_start', 'valid_end'):
+        index[col]=pd.to_datetime(index[col], utc=True, errors='coerce')
+    return index.sort_values(['valid_start', 'product', 'number'], kind='stable').reset_index(drop=True)
+
+def products_valid_at(index, time):
+    '''Returns the rows of a product index valid at time (a timestamp or string, UTC if no timezone is given)'''
+    time=pd.Timestamp(time)
+    time=time.tz_localize('UTC') if time.tzinfo is None else time.tz_convert('UTC')
+    return index[(index['valid_start']<=time) & (index['valid_end']>=time)]
+
+
+class OutlookGrid:
+    '''Grid that outlooks are rasterized onto. Grid points are held in a spatial index, and the points inside each polygon are cached'''
+    '''Params:
+    lats, lons: 2D arrays of grid point latitudes and longitudes
+    crs: CRS of lats/lons. Outlooks are reprojected to it
+    cache_size: number of polygons whose enclosed points are kept. Outlooks repeat across categories and reloads, so these are reused
+    '''
+    
+    def __init__(self, lats, lons, crs='EPSG:4326', cache_size=4096):
+        self.lats=np.asarray(lats)
+        self.lons=np.asarray(lons)
+        if self.lats.shape!=self.lons.shape:
+            raise ValueError(f'lats and lons must have the same shape, got {self.lats.shape} and {self.lons.shape}')
+        self.shape=self.lats.shape
+        self.crs=crs
+        self.cache_size=cache_size
+        self.tree=shapely.STRtree(shapely.points(self.lons.ravel(), self.lats.ravel()))
+        self._indices=OrderedDict()
+    
+    def polygon_indices(self, poly):
+        '''Returns the flat indices of the grid points inside or on the boundary of poly'''
+        key=shapely.to_wkb(poly)
+        if key in self._indices:
+            self._indices.move_to_end(key)
+            return self._indices[key]
+        indices=np.sort(self.tree.query(poly, predicate='intersects')).astype(np.int64)
+        self._indices[key]=indices
+        if len(self._indices)>self.cache_size:
+            self._indices.popitem(last=False)
+        return indices
+    
+    def rasterize(self, outlook, ignore_dn=()):
+        '''Returns a uint8 array of the grid shape with the highest DN of the polygons in outlook enclosing each point'''
+        if outlook.crs is not None and self.crs is not None:
+            outlook=outlook.to_crs(self.crs)
+        raster=np.zeros(self.lats.size, dtype=np.uint8)
+        for poly, dn in zip(outlook.geometry, outlook.DN):
+            if dn in ignore_dn or poly is None or poly.is_empty:
+                continue
+            indices=self.polygon_indices(poly)
+            raster[indices]=np.maximum(raster[indices], dn) #Indices are unique, so this is safe without ufunc.at
+        return raster.reshape(self.shape)
+
+_outlook_grids={}
+
+def get_outlook_grid(lats, lons, crs='EPSG:4326'):
+    '''Returns the OutlookGrid for lats/lons, reusing the one built for an identical grid'''
+    lats, lons=np.ascontiguousarray(lats), np.ascontiguousarray(lons)
+    key=(hashlib.sha1(lats.tobytes()+lons.tobytes()).hexdigest(), lats.shape, str(crs))
+    if key not in _outlook_grids:
+        _outlook_grids[key]=OutlookGrid(lats, lons, crs)
+    return _outlook_grids[key]
+
+
+def _crs_key(crs):
+    #Hashable key for a pyproj/cartopy CRS or a CRS string
+    return crs.to_wkt() if hasattr(crs, 'to_wkt') else str(crs)
+
+def _ring_path(ring):
+    coords=np.asarray(ring.coords)[:, :2]
+    Path=mpath.Path
+    codes=np.full(len(coords), Path.LINETO, dtype=Path.code_type)
+    codes[0]=Path.MOVETO
+    codes[-1]=Path.CLOSEPOLY
+    return coords, codes
+
+def _polygon_path(geom):
+    #Compound matplotlib path of a (Multi)Polygon, including holes
+    polys=getattr(geom, 'geoms', [geom])
+    rings=[ring for poly in polys if not poly.is_empty for ring in [poly.exterior, *poly.interiors]]
+    if not rings:
+        return mpath.Path(np.empty((0, 2)))
+    parts=[_ring_path(ring) for ring in rings]
+    return mpath.Path(np.concatenate([coords for coords, _ in parts]), np.concatenate([codes for _, codes in parts]))
+
+def project_outlooks(outlooks, crs):
+    '''Reprojects the geometry of many SPCoutlook instances to crs with a single transform, filling each one's CRS cache'''
+    key=_crs_key(crs)
+    todo=[outlook for outlook in outlooks if key not in outlook._projected]
+    if not todo:
+        return
+    for src_crs in {outlook.outlook.crs for outlook in todo}:
+        group=[outlook for outlook in todo if outlook.outlook.crs==src_crs]
+        combined=gpd.GeoSeries(pd.concat([outlook.outlook.geometry for outlook in group], ignore_index=True), crs=src_crs).to_crs(crs)
+        start=0
+        for outlook in group:
+            n=len(outlook.outlook)
+            outlook._projected[key]=combined.iloc[start:start+n].set_axis(outlook.outlook.index)
+            start+=n
+
+def add_outlooks_to_axes(outlooks, axes, crs, titles=True):
+    '''Plots each SPCoutlook onto the matching axis of a grid of axes, e.g. one panel per date'''
+    '''Params:
+    outlooks: list of SPCoutlook instances
+    axes: axes to plot on, e.g. from plt.subplots. Flattened and paired with outlooks in order
+    crs: projection that data is being plotted in
+    titles: If true, each axis is titled with the outlook date
+    '''
+    '''Returns a list of the PathCollection added to each axis'''
+    axes=np.asarray(axes).ravel()
+    project_outlooks(outlooks, crs)
+    collections=[]
+    for outlook, ax in zip(outlooks, axes):
+        collections.append(outlook.add_to_ax(ax, crs))
+        if titles:
+            ax.set_title(outlook.date)
+    return collections
@@ -15,29 +15,75 @@ import numpy as np
 ###Thermodynamics###
 ####################
 
-def SatVapPressure(T, T_units='K', P_units='Pa'):
+#Constants
+A=2.53*10**11 #Pa
+B=5.42*10**3 #K
+R=8.314 #J/(kg*mol)
+M_d=28.97 #Molar mass of dry air; g/mol
+M_w=18.016 #Molar mass of water; g/mol
+R_d=1000*R/M_d #Gas constant for dry air; J/(k*Kg)
+R_v=1000*R/M_w #Gas constant for water vapor; J/(k*kg)
+Epsilon=R_d/R_v
+C_p=1004. #Specific heat of dry air at constant pressure; J/(K*kg)
+L_v=2.5*10**6 #Latent heat of vaporization; J/kg
+P_0=100000. #Reference pressure for potential temperature; Pa
+
+#Fields that can be requested from moist_thermo()
+THERMO_FIELDS=('vapor_pressure', 'sat_vapor_pressure', 'sat_mixing_ratio', 'relative_humidity', 'dewpoint',
+               'potential_temperature', 'lcl_temperature', 'lcl_pressure', 'equivalent_potential_temperature')
+
+
+def _thermo_dtype(dtype, *arrays):
+	#Output dtype for the thermodynamic functions: dtype if given, else the floating type of the inputs, else float64
+	if dtype is not None:
+		return np.dtype(dtype)
+	dtype=np.result_type(*arrays)
+	return dtype if np.issubdtype(dtype, np.floating) else np.dtype(np.float64)
+
+
+def _to_kelvin(T, T_units, out):
+	#Writes T in K into out
+	if T_units=='C':
+		np.add(T, 273.15, out=out) #Convert temperature in C to K
+	elif T_units=='K':
+		out[...]=T
+	else:
+		raise ValueError(f'T_units must be K or C, got {T_units}')
+	return out
+
+
+def _pressure_scale(P_units):
+	#Factor that converts a pressure in P_units to Pa
+	if P_units=='Pa':
+		return 1.
+	elif P_units=='hPa':
+		return 100.
+	raise ValueError(f'P_units must be Pa or hPa, got {P_units}')
+
+
+def SatVapPressure(T, T_units='K', P_units='Pa', out=None, dtype=None):
 	#SatVapPressure calculates the saturation vapor pressure at a given temperature
 
-	#T- Input temperature for the saturation vapor pressure
+	#T- Input temperature for the saturation vapor pressure. Scalar or array of any shape
 	#T_units: unit of the input temperature, Can be either K or C
 	#P_units: Unit of the output saturation vapor pressure, can be hPa or Pa
+	#out: optional preallocated array of shape T. Passing T itself computes in place
+	#dtype: dtype of the output, e.g. np.float32. Defaults to the dtype of T (float64 for integer input)
 
-	#Constants:
-	A=2.53*10**11 #Pa
-	B=5.42*10**3 #K
+	T=np.asanyarray(T)
+	scale=_pressure_scale(P_units)
+	if out is None:
+		out=np.empty(T.shape, dtype=_thermo_dtype(dtype, T))
 
-	if T_units=='C':
-		T=273.15+T #Convert temperature in C to K
-	
-	e_s=A*exp(-B/T) #Saturation vapor pressure in Pa
+	e_s=_to_kelvin(T, T_units, out)
+	np.divide(-B, e_s, out=e_s)
+	np.exp(e_s, out=e_s)
+	e_s*=A/scale #Saturation vapor pressure in P_units
 
-	if e_s=='hPa':
-		e_s=e_s/100
-	
-	return e_s
+	return e_s if e_s.ndim else e_s[()]
 
 
-def SatMixingRatio(T, P, T_units='K', P_units='Pa', return_e_s=True):
+def SatMixingRatio(T, P, T_units='K', P_units='Pa', return_e_s=True, out=None, dtype=None):
 	#Calculates the saturation mixing ratio at a given temperature and pressure
 
 	#T: input temperature in units T_units
@@ -45,21 +91,22 @@ def SatMixingRatio(T, P, T_units='K', P_units='Pa', return_e_s=True):
 	#T_units: units of temperature input, can be K or C
 	#P_units: units of pressure input, can be Pa or hPa
 	#return_e_s: Boolean. If true, SatMixingRatio() returns Saturation mixing ratio and saturation vapor pressure
+	#out: optional preallocated array for the saturation mixing ratio
+	#dtype: dtype of the output, e.g. np.float32. Defaults to the dtype of T and P
 
+	T=np.asanyarray(T)
+	P=np.asanyarray(P)
+	dtype=_thermo_dtype(dtype, T, P)
 
-	#Constants
-	R=8.314 #J/(kg*mol)
-	M_d=28.97 #Molar mass of dry air; g/mol
-	M_w=18.016 #Molar mass of water; g/mol
-	R_d=1000*R/M_d #Gas constant for dry air; J/(k*Kg)
-	R_v=1000*R/M_w #Gas constant for water vapor; J/(k*kg)
-	Epsilon=R_d/R_v
-
-	#Saturation Vapor pressure
-	e_s=SatVapPressure(T, T_units, P_units)
+	#Saturation Vapor pressure, in the same units as P so no conversion is needed
+	e_s=SatVapPressure(T, T_units, P_units, dtype=dtype)
 
 	#Saturation Mixing ratio-- returns as a ratio, i.e. not g/kg
-	w_s=(Epsilon*e_s)/(P-e_s)
+	if out is None:
+		out=np.empty(np.broadcast(T, P).shape, dtype=dtype)
+	w_s=np.subtract(P, e_s, out=out)
+	np.divide(Epsilon*e_s, w_s, out=w_s)
+	w_s=w_s if w_s.ndim else w_s[()]
 
 	if return_e_s:
 		return w_s, e_s
@@ -67,6 +114,129 @@ def SatMixingRatio(T, P, T_units='K', P_units='Pa', return_e_s=True):
 		return w_s
 
 
+def moist_thermo(T, P, w, T_units='K', P_units='Pa', fields=THERMO_FIELDS, out=None, dtype=None):
+	#Calculates derived moist thermodynamic quantities on a grid, sharing intermediate results between them
+
+	#T: temperature in T_units. Array of any shape
+	#P: pressure in P_units. Broadcastable to T
+	#w: water vapor mixing ratio (kg/kg). Broadcastable to T
+	#T_units: units of temperature input, can be K or C
+	#P_units: units of pressure input and of the returned pressures, can be Pa or hPa
+	#fields: names of fields to return. Any of THERMO_FIELDS
+	#out: optional dict of preallocated arrays keyed by field name
+	#dtype: dtype of the outputs, e.g. np.float32. Defaults to the dtype of the inputs
+
+	#Temperatures are returned in K. Relative humidity is a ratio, not %.
+	#The dewpoint and LCL use the same vapor pressure formula as SatVapPressure, and the LCL temperature follows Bolton (1980)
+
+	#Returns dict of {field: array}
+
+	for field in fields:
+		if field not in THERMO_FIELDS:
+			raise ValueError(f'Unknown field {field}. Valid: {list(THERMO_FIELDS)}')
+	T=np.asanyarray(T)
+	P=np.asanyarray(P)
+	w=np.asanyarray(w)
+	dtype=_thermo_dtype(dtype, T, P, w)
+	shape=np.broadcast(T, P, w).shape
+	scale=_pressure_scale(P_units)
+	out={} if out is None else dict(out)
+	requested=set(fields)
+
+	def _field(name):
+		#Returns the output array for name if it was requested, otherwise a scratch array
+		if name in requested and name not in out:
+			out[name]=np.empty(shape, dtype=dtype)
+		return out[name] if name in requested else np.empty(shape, dtype=dtype)
+
+	def _needs(*names):
+		return bool(requested.intersection(names))
+
+	T_K=_to_kelvin(T, T_units, np.empty(shape, dtype=dtype))
+	P_Pa=np.multiply(P, scale, dtype=dtype)
+
+	#Vapor pressure (Pa) from the mixing ratio: e = wP/(Epsilon+w)
+	if _needs('vapor_pressure', 'relative_humidity', 'dewpoint', 'lcl_temperature', 'lcl_pressure', 'equivalent_potential_temperature'):
+		e=_field('vapor_pressure')
+		np.add(w, Epsilon, out=e)
+		np.divide(P_Pa*w, e, out=e)
+
+	if _needs('sat_vapor_pressure', 'sat_mixing_ratio', 'relative_humidity'):
+		e_s=SatVapPressure(T_K, 'K', 'Pa', out=_field('sat_vapor_pressure'))
+		if _needs('sat_mixing_ratio'):
+			w_s=_field('sat_mixing_ratio')
+			np.subtract(P_Pa, e_s, out=w_s)
+			np.divide(Epsilon*e_s, w_s, out=w_s)
+		if _needs('relative_humidity'):
+			np.divide(e, e_s, out=_field('relative_humidity'))
+
+	#Dewpoint (K), inverting e=A*exp(-B/T_d)
+	if _needs('dewpoint', 'lcl_temperature', 'lcl_pressure', 'equivalent_potential_temperature'):
+		T_d=_field('dewpoint')
+		np.divide(A, e, out=T_d)
+		np.log(T_d, out=T_d)
+		np.divide(B, T_d, out=T_d)
+
+	if _needs('potential_temperature', 'equivalent_potential_temperature'):
+		theta=_field('potential_temperature')
+		np.divide(P_0, P_Pa, out=theta)
+		np.power(theta, R_d/C_p, out=theta)
+		theta*=T_K
+
+	#LCL temperature (K): T_L = 1/(1/(T_d-56) + ln(T/T_d)/800) + 56
+	if _needs('lcl_temperature', 'lcl_pressure', 'equivalent_potential_temperature'):
+		T_L=_field('lcl_temperature')
+		np.divide(T_K, T_d, out=T_L)
+		np.log(T_L, out=T_L)
+		T_L/=800
+		T_L+=1/(T_d-56)
+		np.reciprocal(T_L, out=T_L)
+		T_L+=56
+
+	#LCL pressure by dry adiabatic ascent: P_L = P*(T_L/T)^(C_p/R_d)
+	if _needs('lcl_pressure'):
+		P_L=_field('lcl_pressure')
+		np.divide(T_L, T_K, out=P_L)
+		np.power(P_L, C_p/R_d, out=P_L)
+		P_L*=P_Pa/scale
+
+	#Equivalent potential temperature (K): theta*exp(L_v*w/(C_p*T_L))
+	if _needs('equivalent_potential_temperature'):
+		theta_e=_field('equivalent_potential_temperature')
+		np.multiply(w, L_v/C_p, out=theta_e)
+		theta_e/=T_L
+		np.exp(theta_e, out=theta_e)
+		theta_e*=theta
+
+	return {field: out[field] if out[field].ndim else out[field][()] for field in fields}
+
+
+def Dewpoint(T, P, w, T_units='K', P_units='Pa', **kwargs):
+	#Dewpoint (K) from mixing ratio w. See moist_thermo for arguments
+	return moist_thermo(T, P, w, T_units, P_units, fields=('dewpoint',), **kwargs)['dewpoint']
+
+
+def RelativeHumidity(T, P, w, T_units='K', P_units='Pa', **kwargs):
+	#Relative humidity (ratio) from mixing ratio w. See moist_thermo for arguments
+	return moist_thermo(T, P, w, T_units, P_units, fields=('relative_humidity',), **kwargs)['relative_humidity']
+
+
+def PotentialTemperature(T, P, T_units='K', P_units='Pa', **kwargs):
+	#Potential temperature (K). See moist_thermo for arguments
+	return moist_thermo(T, P, 0., T_units, P_units, fields=('potential_temperature',), **kwargs)['potential_temperature']
+
+
+def EquivalentPotentialTemperature(T, P, w, T_units='K', P_units='Pa', **kwargs):
+	#Equivalent potential temperature (K) from mixing ratio w. See moist_thermo for arguments
+	return moist_thermo(T, P, w, T_units, P_units, fields=('equivalent_potential_temperature',), **kwargs)['equivalent_potential_temperature']
+
+
+def LCL(T, P, w, T_units='K', P_units='Pa', **kwargs):
+	#Temperature (K) and pressure (P_units) of the lifting condensation level. See moist_thermo for arguments
+	lcl=moist_thermo(T, P, w, T_units, P_units, fields=('lcl_temperature', 'lcl_pressure'), **kwargs)
+	return lcl['lcl_temperature'], lcl['lcl_pressure']
+
+
 
 ####################
 ####Computation#####
@@ -74,113 +244,459 @@ def SatMixingRatio(T, P, T_units='K', P_units='Pa', return_e_s=True):
 
 #Check the axes for this
 
-def forward_differencing(X, delta_x, axis=0):
-
-	#Function that calculates the partial derivative of some function F using forward differencing
-	#This will not work for the last element of an array
-
-	#X: 2D array of values F(x)
-	#delta_x: distance between grid points
-	#axis: axis to calculate the derivative along (x=0, y=1)
-
-	#df_dx: array of shape X with approximations of derivative. Either the top or rightmost row will be zeroes
-
+#Shifts (ahead, behind) of the stencil for each differencing scheme
+_DIFF_SCHEMES={'forward':(1,0), 'backward':(0,-1), 'centered':(1,-1)}
 
-	length=np.shape(X) #Length of array along the dimension axis
-
-
-	df_dx=np.zeros_like(X)
-
-	i=0 #X
-	j=length[0]-1 #Y
 
+def finite_difference(X, delta_x, axis=-1, scheme='forward', reverse=False, out=None, dtype=None):
+	#Array-slicing finite difference engine used by forward/backward/centered_differencing
+	#Works on N-D arrays, so leading dimensions (e.g. member, time) are batched in one call
 
+	#X: N-D array of values F(x). Memory-mapped arrays are only read through slices
+	#delta_x: distance between grid points
+	#axis: array axis to calculate the derivative along
+	#scheme: 'forward', 'backward', or 'centered'
+	#reverse: If true, the coordinate increases towards lower indices along axis (e.g. rows counted from the top)
+	#out: optional preallocated array of shape X to write the derivative into
+	#dtype: dtype of the output. Defaults to out.dtype, then X.dtype for floating X, otherwise float64
+	#       (integer X gives a float64 derivative; the original loop versions returned a truncated integer array)
+
+	#df_dx: array of shape X with approximations of derivative. Points without a full stencil are zero
+
+	if scheme not in _DIFF_SCHEMES:
+		raise ValueError(f'scheme must be one of {list(_DIFF_SCHEMES)}, got {scheme}')
+
+	X=np.asanyarray(X)
+	if not -X.ndim<=axis<X.ndim:
+		raise ValueError(f'axis {axis} is out of bounds for array of dimension {X.ndim}')
+	axis=axis%X.ndim
+
+	if out is None:
+		if dtype is None:
+			dtype=X.dtype if np.issubdtype(X.dtype, np.floating) else np.float64
+		out=np.empty(X.shape, dtype=dtype)
+	elif out.shape!=X.shape:
+		raise ValueError(f'out has shape {out.shape}, expected {X.shape}')
+
+	def _along(start, stop):
+		#Index tuple selecting start:stop along axis and everything along the other axes
+		index=[slice(None)]*X.ndim
+		index[axis]=slice(start, stop)
+		return tuple(index)
+
+	ahead, behind=_DIFF_SCHEMES[scheme]
+	if reverse:
+		ahead, behind=-ahead, -behind
+	denom=2*delta_x if scheme=='centered' else delta_x
+
+	#Interior points [lo, hi) are the ones where the whole stencil lies inside the array
+	n=X.shape[axis]
+	lo=max(0, -min(ahead, behind))
+	hi=max(lo, n-max(0, ahead, behind))
+
+	if hi>lo:
+		df=out[_along(lo, hi)]
+		np.subtract(X[_along(lo+ahead, hi+ahead)], X[_along(lo+behind, hi+behind)], out=df)
+		np.divide(df, denom, out=df)
+	out[_along(0, lo)]=0
+	out[_along(hi, None)]=0
+
+	return out
+
+
+def _legacy_axis(axis):
+	#Converts the (x=0, y=1) axis convention of the *_differencing functions to an array axis
 	if axis==0:
-				
-		while i<length[1]-1:
-			df_dx[:,i]=(X[:,i+1]-X[:,i])/delta_x
-			i+=1
-		
-	
+		return -1
 	elif axis==1:
-		while j>0:
-			df_dx[j,:]=(X[j-1,:]-X[j,:])/delta_x
-			j-=1
-			
-	return df_dx
+		return -2
+	raise ValueError(f'axis must be 0 (x) or 1 (y), got {axis}')
 
 
+def forward_differencing(X, delta_x, axis=0, out=None, dtype=None):
 
-def backward_differencing(X, delta_x, axis=0):
-	 #Function that calculates the partial derivative of some function F using backward differencing
-         #This will not work for the last element of an array
+	#Function that calculates the partial derivative of some function F using forward differencing
+	#This will not work for the last element of an array
 
-         #X: 2D array of values F(x)
-         #delta_x: distance between grid points
-         #axis: axis to calculate the derivative along (x=0, y=1)
-         #df_dx: array of shape X with approximations of derivative. Either the top or rightmost row will be zeroes
+	#X: N-D array of values F(x). The last two dimensions are (y, x); any leading dimensions are batched
+	#delta_x: distance between grid points
+	#axis: axis to calculate the derivative along (x=0, y=1)
+	#out, dtype: see finite_difference. Integer X gives a float64 result
 
+	#df_dx: array of shape X with approximations of derivative. Either the top or rightmost row will be zeroes
 
-	length=np.shape(X) #Length of array along the dimension axis
+	return finite_difference(X, delta_x, axis=_legacy_axis(axis), scheme='forward', reverse=(axis==1), out=out, dtype=dtype)
 
 
-	df_dx=np.zeros_like(X)
-	i=1 #X
-	j=1 #Y
 
+def backward_differencing(X, delta_x, axis=0, out=None, dtype=None):
+	#Function that calculates the partial derivative of some function F using backward differencing
+	#This will not work for the first element of an array
 
-	if axis==0:
-		while i<length[1]: #For each column except the first
-			df_dx[:,i]=(X[:,i]-X[:,i-1])/delta_x
-			i+=1
+	#X: N-D array of values F(x). The last two dimensions are (y, x); any leading dimensions are batched
+	#delta_x: distance between grid points
+	#axis: axis to calculate the derivative along (x=0, y=1)
+	#out, dtype: see finite_difference. Integer X gives a float64 result
 
-	elif axis==1:
-		while j<length[0]:
-			df_dx[j,:]=(X[j,:]-X[j-1,:])/delta_x
-			j+=1
+	#df_dx: array of shape X with approximations of derivative. Either the top or leftmost row will be zeroes
 
-	return df_dx
+	return finite_difference(X, delta_x, axis=_legacy_axis(axis), scheme='backward', out=out, dtype=dtype)
 
 
 
-def centered_differencing(X, delta_x, axis=0):
+def centered_differencing(X, delta_x, axis=0, out=None, dtype=None):
 	#Function that calculates the partial derivative of some function F using centered finite differencing
 	#Will not work for the boundaries of X
 
-	#X: 2d array of values F(x)
+	#X: N-D array of values F(x). The last two dimensions are (y, x); any leading dimensions are batched
 	#Delta_x: distance between grid points
 	#Axis: Axis to calculate the derivative along (x=0, y=1)
-	#df_dx: array of shape x with approximations of derivative. First/last columns/rows will be zero, depending on axis.
+	#out, dtype: see finite_difference. Integer X gives a float64 result
 
-	length=np.shape(X)
+	#df_dx: array of shape x with approximations of derivative. First/last columns/rows will be zero, depending on axis.
 
-	df_dx=np.zeros_like(X)
+	return finite_difference(X, delta_x, axis=_legacy_axis(axis), scheme='centered', reverse=(axis==1), out=out, dtype=dtype)
 
 
-	i=1 #Index for x, starts at 1 to avoid boundary issues
-	j=length[0]-2 #index for y, starts at the second to last index and moves up
 
-	if axis==0:
-		while i<length[1]-1:
-			df_dx[:,i]=(X[:,i+1]-X[:,i-1])/(2*delta_x)
-			i+=1
-	if axis==1:
-		while j>0:
-			df_dx[j,:]=(X[j-1,:]-X[j+1,:])/(2*delta_x)
-			j-=1
-	return df_dx
+####################
+#####Kinematics#####
+####################
 
+#Fields that can be requested from kinematics(). Each is built from the four velocity derivatives
+KINEMATIC_FIELDS=('divergence', 'vorticity', 'shear_deformation', 'stretching_deformation', 'okubo_weiss')
 
 
+def gradient(F, delta_x, delta_y=None, out=None, dtype=None, y_reversed=False):
+	#Calculates the horizontal gradient of F using centered differencing
 
+	#F: N-D array with (y, x) as the last two dimensions
+	#delta_x, delta_y: distance between grid points in x and y. delta_y defaults to delta_x
+	#out: optional tuple of two preallocated arrays of shape F for (dF/dx, dF/dy)
+	#dtype: dtype of the output, see finite_difference
+	#y_reversed: By default row 0 is the southernmost row and y increases with the row index, as on WRF/WoFS grids.
+	#            If true, row 0 is the northernmost row (image order, e.g. flipped for plotting), which is the
+	#            convention of centered_differencing(axis=1)
 
+	#Returns dF_dx, dF_dy
 
+	delta_y=delta_x if delta_y is None else delta_y
+	out_x, out_y=out if out is not None else (None, None)
+	dF_dx=finite_difference(F, delta_x, axis=-1, scheme='centered', out=out_x, dtype=dtype)
+	dF_dy=finite_difference(F, delta_y, axis=-2, scheme='centered', reverse=y_reversed, out=out_y, dtype=dtype)
+	return dF_dx, dF_dy
 
 
+def _second_difference(X, delta_x, axis, out):
+	#Adds the centered second derivative of X along axis to out. Points without a full stencil are left alone
+	n=X.shape[axis]
+	if n<3:
+		return out
 
+	def _along(start, stop):
+		index=[slice(None)]*X.ndim
+		index[axis]=slice(start, stop)
+		return tuple(index)
 
+	interior=out[_along(1, n-1)]
+	interior+=(X[_along(2, None)]-2*X[_along(1, n-1)]+X[_along(0, n-2)])/delta_x**2
+	return out
 
 
+def laplacian(F, delta_x, delta_y=None, out=None, dtype=None):
+	#Calculates the horizontal Laplacian of F using centered second differences
 
+	#F: N-D array with (y, x) as the last two dimensions
+	#delta_x, delta_y: distance between grid points in x and y. delta_y defaults to delta_x
+	#out: optional preallocated array of shape F
+	#dtype: dtype of the output, see finite_difference
 
+	#Returns array of shape F. Each second derivative is zero on its own boundary rows/columns
 
+	F=np.asanyarray(F)
+	delta_y=delta_x if delta_y is None else delta_y
+	if out is None:
+		if dtype is None:
+			dtype=F.dtype if np.issubdtype(F.dtype, np.floating) else np.float64
+		out=np.zeros(F.shape, dtype=dtype)
+	else:
+		out[...]=0
+
+	_second_difference(F, delta_x, -1, out)
+	_second_difference(F, delta_y, -2, out)
+	return out
+
+
+def _combine_kinematics(du_dx, du_dy, dv_dx, dv_dy, fields, out):
+	#Builds the requested fields from the four velocity derivatives, writing into the arrays in out
+	for field in fields:
+		dest=out[field]
+		if field=='divergence':
+			np.add(du_dx, dv_dy, out=dest)
+		elif field=='vorticity':
+			np.subtract(dv_dx, du_dy, out=dest)
+		elif field=='shear_deformation':
+			np.add(dv_dx, du_dy, out=dest)
+		elif field=='stretching_deformation':
+			np.subtract(du_dx, dv_dy, out=dest)
+		elif field=='okubo_weiss':
+			#W = stretching^2 + shear^2 - vorticity^2
+			#  = (du_dx-dv_dy)^2 + 4*du_dy*dv_dx, which avoids materializing the three intermediate fields
+			np.subtract(du_dx, dv_dy, out=dest)
+			np.square(dest, out=dest)
+			dest+=4*du_dy*dv_dx
+
+
+def kinematics(u, v, delta_x, delta_y=None, fields=('divergence', 'vorticity', 'okubo_weiss'), out=None, dtype=None, tile_rows=None, y_reversed=False):
+	#Calculates kinematic fields from u/v stacks, sharing the four velocity derivatives between fields
+
+	#u, v: N-D arrays of wind components with (y, x) as the last two dimensions. May be memory-mapped
+	#delta_x, delta_y: distance between grid points in x and y. delta_y defaults to delta_x
+	#fields: names of fields to return. Any of KINEMATIC_FIELDS
+	#out: optional dict of preallocated arrays of shape u (e.g. np.memmap), keyed by field name
+	#dtype: dtype of the outputs, see finite_difference
+	#tile_rows: If given, the grid is processed in blocks of this many y rows so memory stays bounded.
+	#           Each block reads one extra row on either side so the results match the untiled calculation
+	#y_reversed: If true, row 0 is the northernmost row rather than the southernmost. See gradient
+
+	#Returns dict of {field: array of shape u}
+
+	u=np.asanyarray(u)
+	v=np.asanyarray(v)
+	if u.shape!=v.shape:
+		raise ValueError(f'u and v must have the same shape, got {u.shape} and {v.shape}')
+	if u.ndim<2:
+		raise ValueError('u and v must have (y, x) as their last two dimensions')
+	for field in fields:
+		if field not in KINEMATIC_FIELDS:
+			raise ValueError(f'Unknown field {field}. Valid: {list(KINEMATIC_FIELDS)}')
+	delta_y=delta_x if delta_y is None else delta_y
+
+	if dtype is None:
+		dtype=np.result_type(u.dtype, v.dtype)
+		dtype=dtype if np.issubdtype(dtype, np.floating) else np.float64
+	out={} if out is None else dict(out)
+	for field in fields:
+		if field not in out:
+			out[field]=np.empty(u.shape, dtype=dtype)
+
+	ny=u.shape[-2]
+	tile_rows=ny if tile_rows is None else max(1, int(tile_rows))
+
+	#Scratch buffers for the derivatives are reused from tile to tile
+	buffers=None
+	for start in range(0, ny, tile_rows):
+		stop=min(start+tile_rows, ny)
+		#Halo of one row on each side, except at the true grid boundaries
+		lo, hi=max(start-1, 0), min(stop+1, ny)
+		u_tile=np.asarray(u[..., lo:hi, :], dtype=dtype)
+		v_tile=np.asarray(v[..., lo:hi, :], dtype=dtype)
+
+		if buffers is None or buffers[0].shape!=u_tile.shape:
+			buffers=[np.empty(u_tile.shape, dtype=dtype) for _ in range(4)]
+		du_dx, du_dy, dv_dx, dv_dy=buffers
+		gradient(u_tile, delta_x, delta_y, out=(du_dx, du_dy), y_reversed=y_reversed)
+		gradient(v_tile, delta_x, delta_y, out=(dv_dx, dv_dy), y_reversed=y_reversed)
+
+		#Strip the halo rows before combining
+		keep=(Ellipsis, slice(start-lo, stop-lo), slice(None))
+		tile_out={field: out[field][..., start:stop, :] for field in fields}
+		_combine_kinematics(du_dx[keep], du_dy[keep], dv_dx[keep], dv_dy[keep], fields, tile_out)
+
+	return {field: out[field] for field in fields}
+
+
+def divergence(u, v, delta_x, delta_y=None, **kwargs):
+	#Horizontal divergence du/dx + dv/dy. See kinematics for arguments
+	return kinematics(u, v, delta_x, delta_y, fields=('divergence',), **kwargs)['divergence']
+
+
+def vorticity(u, v, delta_x, delta_y=None, **kwargs):
+	#Relative vertical vorticity dv/dx - du/dy. See kinematics for arguments
+	return kinematics(u, v, delta_x, delta_y, fields=('vorticity',), **kwargs)['vorticity']
+
+
+def okubo_weiss(u, v, delta_x, delta_y=None, **kwargs):
+	#Okubo-Weiss parameter: stretching^2 + shear^2 - vorticity^2. See kinematics for arguments
+	return kinematics(u, v, delta_x, delta_y, fields=('okubo_weiss',), **kwargs)['okubo_weiss']
+
+
+##########################
+###Ensemble Statistics###
+##########################
+
+#Statistics that can be requested from ensemble_stats(), named as in the ML predictor columns (variable__category__neighborhood__statistic)
+#Each order statistic is (position in the sorted members as a fraction of n-1, or a member offset from the low/high end)
+#2nd and 16th are the 2nd lowest and 2nd highest members, following the Drop_Unwanted_Variables notes
+ENSEMBLE_STATS=('mean', 'std', 'min', 'max', 'median', 'IQR', '2nd', '16th', '90th', '10th', '25th', '75th')
+_ORDER_STATS={'min':('rank', 0), 'max':('rank', -1), '2nd':('rank', 1), '16th':('rank', -2),
+			  'median':('percentile', 50), '10th':('percentile', 10), '25th':('percentile', 25), '75th':('percentile', 75), '90th':('percentile', 90)}
+
+
+def _order_positions(stat, n_members):
+	#Returns (lower index, upper index, weight of upper) of a statistic in the sorted members. Percentiles interpolate linearly, as np.percentile
+	kind, value=_ORDER_STATS[stat]
+	if kind=='rank':
+		index=value if value>=0 else n_members+value
+		return index, index, 0.
+	position=value/100*(n_members-1)
+	lower=int(np.floor(position))
+	return lower, min(lower+1, n_members-1), position-lower
+
+
+def ensemble_stats(F, stats=('mean', 'IQR', '2nd', '16th', '90th'), member_axis=0, out=None, dtype=np.float32, tile_rows=None):
+	#Calculates ensemble summary statistics of a member stack in one pass
+	#Every order statistic (percentiles, IQR, 2nd lowest/highest) comes from one partial sort of the members, which places all of the
+	#needed ranks at once, instead of a separate sort for each percentile
+
+	#F: N-D array with a member dimension, e.g. (member, y, x), or (variable, time, member, y, x) to batch over variables and times. May be memory-mapped
+	#stats: names of statistics to return. Any of ENSEMBLE_STATS
+	#member_axis: axis of F holding the ensemble members
+	#out: optional dict of preallocated arrays of shape F without member_axis, keyed by statistic
+	#dtype: dtype of the outputs and of the working copy of the members. float32 by default
+	#tile_rows: If given, the second to last output axis (y for (..., y, x) stacks) is processed in blocks of this many rows so memory stays bounded
+
+	#Returns dict of {statistic: array of shape F without member_axis}
+
+	F=np.asanyarray(F)
+	for stat in stats:
+		if stat not in ENSEMBLE_STATS:
+			raise ValueError(f'Unknown statistic {stat}. Valid: {list(ENSEMBLE_STATS)}')
+	F=np.moveaxis(F, member_axis, 0)
+	n_members=F.shape[0]
+	shape=F.shape[1:]
+	out={} if out is None else dict(out)
+	for stat in stats:
+		if stat not in out:
+			out[stat]=np.empty(shape, dtype=dtype)
+
+	#Order statistics needed by every requested statistic, shared between them (e.g. IQR and 25th/75th)
+	order={stat: _order_positions(stat, n_members) for stat in stats if stat in _ORDER_STATS}
+	if 'IQR' in stats:
+		order['25th']=_order_positions('25th', n_members)
+		order['75th']=_order_positions('75th', n_members)
+	kth=sorted({index for lower, upper, _ in order.values() for index in (lower, upper)})
+
+	if len(shape)<2:
+		tiles=[(Ellipsis,)]
+	else:
+		rows=shape[-2] if tile_rows is None else max(1, int(tile_rows))
+		tiles=[(Ellipsis, slice(start, start+rows), slice(None)) for start in range(0, shape[-2], rows)]
+
+	for tile in tiles:
+		members=np.array(F[(slice(None),)+tile], dtype=dtype) #Working copy, partially sorted in place below
+		tile_out={stat: out[stat][tile] for stat in stats}
+		if 'mean' in stats:
+			np.mean(members, axis=0, out=tile_out['mean'])
+		if 'std' in stats:
+			np.std(members, axis=0, out=tile_out['std'])
+		if kth:
+			members.partition(kth, axis=0)
+		values={}
+		for stat, (lower, upper, weight) in order.items():
+			if weight==0:
+				values[stat]=members[lower]
+			else:
+				values[stat]=members[lower]+(members[upper]-members[lower])*np.asarray(weight, dtype=dtype)
+		for stat in stats:
+			if stat=='IQR':
+				np.subtract(values['75th'], values['25th'], out=tile_out['IQR'])
+			elif stat in _ORDER_STATS:
+				tile_out[stat][...]=values[stat]
+
+	return {stat: out[stat] for stat in stats}
+
+
+##########
+###NMEP###
+##########
+
+def _running_max(X, size, axis, out=None):
+	#Maximum over a centered window of size points along axis, truncated at the edges (the same as scipy's default reflect mode for a maximum)
+	#Uses scipy.ndimage.maximum_filter1d where available, otherwise a numpy doubling scheme taking log2(size) passes
+	X=np.asarray(X)
+	out=np.empty_like(X) if out is None else out
+	if size<=1:
+		out[...]=X
+		return out
+	try:
+		from scipy.ndimage import maximum_filter1d
+	except ImportError:
+		maximum_filter1d=None
+	if maximum_filter1d is not None:
+		return maximum_filter1d(X, size, axis=axis, output=out)
+
+	X=np.moveaxis(X, axis, 0)
+	n=X.shape[0]
+	before=size//2
+	#Edge padding gives the truncated window, since repeated edge values are already inside the window
+	M=np.concatenate([np.repeat(X[:1], before, axis=0), X, np.repeat(X[-1:], size-1-before, axis=0)], axis=0)
+	width=1
+	while 2*width<=size: #After each pass, M[i] is the maximum of the padded values i to i+2*width-1
+		np.maximum(M[:-width], M[width:], out=M[:-width])
+		width*=2
+	np.maximum(M[:n], M[size-width:size-width+n], out=np.moveaxis(out, axis, 0))
+	return out
+
+
+def neighborhood_maximum(F, size, axes=(-2, -1), out=None):
+	#Maximum of F over a size x size square neighborhood centered on each point, as two separable 1-D passes
+	#F: N-D array with the two neighborhood axes given by axes, e.g. (member, y, x)
+	#size: neighborhood width in grid points. Odd sizes are centered on each point
+	#Returns an array of the shape of F
+	tmp=_running_max(F, size, axes[0])
+	return _running_max(tmp, size, axes[1], out=out if out is not None else tmp)
+
+
+def nmep_column(variable, threshold, scale_km):
+	#Name of an NMEP predictor/baseline column, e.g. nmep_column('hailcast', 1.25, 45) -> 'hailcast__nmep_>1_25_45km' (see MlUtils.get_bl_col)
+	return f'{variable}__nmep_>{threshold:g}_{scale_km:g}km'.replace('.', '_')
+
+
+def nmep(F, thresholds, scales_km=(9, 27, 45), dx_km=3., member_axis=0, time_axis=None, variable=None, dtype=np.float32):
+	#Calculates neighborhood maximum ensemble probabilities (NMEP) for several thresholds and neighborhood scales in one call
+	#NMEP is the fraction of members exceeding a threshold anywhere in the square neighborhood around each point
+
+	#F: N-D array of an ensemble field with (y, x) as the last two dimensions, e.g. (member, y, x) or (member, time, y, x). May be memory-mapped
+	#thresholds: list of thresholds. A member exceeds a threshold where F > threshold
+	#scales_km: neighborhood widths in km (9/27/45 km are 3/9/15 points on the 3 km WoFS grid)
+	#dx_km: grid spacing in km
+	#member_axis: axis of F holding the ensemble members
+	#time_axis: If given, F is first reduced to its maximum over this axis (e.g. for time_max baselines over a forecast window)
+	#variable: If given, results are keyed by column name (see nmep_column) instead of (threshold, scale_km)
+	#dtype: dtype of the probabilities
+
+	#The neighborhood maximum of the field is taken before thresholding, which gives the same exceedance masks
+	#(max over the neighborhood > threshold exactly when any point in it exceeds the threshold), so each scale costs one
+	#filter however many thresholds there are. Scales are built incrementally: a width b window applied to a width a maximum
+	#is a width a+b-1 maximum, so each larger scale reuses the previous one
+
+	#Returns dict of {(threshold, scale_km) or column name: array of shape F without member_axis (and time_axis)}
+
+	F=np.asanyarray(F)
+	if time_axis is not None:
+		member_axis, time_axis=member_axis%F.ndim, time_axis%F.ndim
+		member_axis-=member_axis>time_axis
+		F=F.max(axis=time_axis)
+	F=np.moveaxis(F, member_axis, 0)
+	if F.ndim<3:
+		raise ValueError('F must have a member dimension and (y, x) as its last two dimensions')
+	n_members=F.shape[0]
+	sizes={scale: max(1, int(round(scale/dx_km))) for scale in scales_km}
+	for scale, size in sizes.items():
+		if size%2==0:
+			raise ValueError(f'{scale} km is an even number of {dx_km} km grid points, so the neighborhood cannot be centered')
+
+	results={}
+	field=np.array(F, dtype=np.result_type(F.dtype, np.float32))
+	count=np.empty(F.shape[1:], dtype=np.int32)
+	previous=1
+	for scale in sorted(scales_km, key=sizes.get):
+		size=sizes[scale]
+		neighborhood_maximum(field, size-previous+1, out=field) #Widens the previous scale's maximum to this scale in place
+		previous=size
+		for threshold in thresholds:
+			np.sum(field>threshold, axis=0, dtype=np.int32, out=count)
+			key=nmep_column(variable, threshold, scale) if variable is not None else (threshold, scale)
+			results[key]=np.divide(count, n_members, dtype=dtype)
+	return results
@@ -0,0 +1,275 @@
+#Verification of ML probabilities and NMEP baselines against binary targets
+#Every forecast is binned once, and all scores come from the per-bin counts, so data can be scored in chunks
+
+'''Usage:
+    from VargaPy import Verification
+    hist, cis = Verification.verify_ml_and_baselines(y, probs, X_test, target_scale=36, hazard_name='all_severe', timescale='2to6', n_boot=1000)
+    print(hist.summary())
+'''
+
+#########
+#Imports#
+#########
+
+import logging
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from VargaPy.Instrumentation import stage
+from VargaPy.LazyImport import LazyModule
+
+pd=LazyModule('pandas') #Imported the first time it is used
+
+logger=logging.getLogger(__name__)
+
+#Hazard names understood by MlUtils.get_bl_col
+BL_HAZARDS=['hail_severe', 'wind_severe', 'tornado_severe', 'all_severe']
+
+SCORES=['bs', 'bss', 'auc', 'aupdc', 'max_csi', 'max_csi_threshold', 'base_rate']
+
+
+def _bin_index(P, n_bins):
+    #Bin of each forecast probability. Bin k holds [k/n_bins, (k+1)/n_bins); 1.0 goes in the last bin
+    bins=np.floor(np.clip(P, 0, 1)*n_bins).astype(np.int64)
+    np.minimum(bins, n_bins-1, out=bins)
+    return bins
+
+
+class ForecastHistogram:
+    '''Counts of observed events and non-events in probability bins, for several forecasts of the same targets'''
+    '''Params:
+    names: names of the forecasts, e.g. ['ML', 'uh_2to5_instant__nmep_>150_45km']
+    n_bins: number of equal-width probability bins. Thresholds for ROC/CSI are the bin edges
+    '''
+
+    def __init__(self, names, n_bins=100):
+        self.names=list(names)
+        self.n_bins=n_bins
+        shape=(len(self.names), n_bins)
+        self.events=np.zeros(shape) #Weighted count of y=1 in each bin
+        self.nonevents=np.zeros(shape) #Weighted count of y=0 in each bin
+        self.prob_sum=np.zeros(shape) #Sum of forecast probabilities in each bin, for the reliability diagram
+        self.sq_error=np.zeros(len(self.names)) #Sum of (p-y)^2, so the Brier score is exact rather than binned
+
+    def update(self, y, P, weights=None):
+        '''Adds a chunk of targets y (n,) and forecasts P (n, n_forecasts), with optional row weights'''
+        y=np.asarray(y, dtype=np.float64)
+        P=np.asarray(P, dtype=np.float64).reshape(len(y), len(self.names))
+        weights=np.ones(len(y)) if weights is None else np.asarray(weights, dtype=np.float64)
+        bins=_bin_index(P, self.n_bins)
+        self._accumulate(y, P, bins, weights)
+        return self
+
+    def _accumulate(self, y, P, bins, weights):
+        #All forecasts are counted in one bincount by offsetting each forecast's bins
+        size=len(self.names)*self.n_bins
+        flat=(bins+np.arange(len(self.names))*self.n_bins).ravel()
+        w_event=np.repeat(weights*y, len(self.names))
+        w_all=np.repeat(weights, len(self.names))
+        events=np.bincount(flat, weights=w_event, minlength=size)
+        self.events+=events.reshape(self.events.shape)
+        self.nonevents+=(np.bincount(flat, weights=w_all, minlength=size)-events).reshape(self.events.shape)
+        self.prob_sum+=np.bincount(flat, weights=(P*weights[:, None]).ravel(), minlength=size).reshape(self.events.shape)
+        self.sq_error+=(weights[:, None]*(P-y[:, None])**2).sum(axis=0)
+
+    def merge(self, other):
+        '''Adds the counts of another histogram of the same forecasts'''
+        self.events+=other.events
+        self.nonevents+=other.nonevents
+        self.prob_sum+=other.prob_sum
+        self.sq_error+=other.sq_error
+        return self
+
+    def _contingency(self):
+        #Hits/false alarms/misses/correct negatives when forecasting yes for p >= each bin's lower edge
+        hits=np.cumsum(self.events[:, ::-1], axis=1)[:, ::-1]
+        false_alarms=np.cumsum(self.nonevents[:, ::-1], axis=1)[:, ::-1]
+        n_events=self.events.sum(axis=1, keepdims=True)
+        n_nonevents=self.nonevents.sum(axis=1, keepdims=True)
+        return hits, false_alarms, n_events-hits, n_nonevents-false_alarms
+
+    def scores(self):
+        '''Returns a dict of {score: array over forecasts} for every score in SCORES'''
+        hits, false_alarms, misses, _=self._contingency()
+        n_events=self.events.sum(axis=1)
+        n=n_events+self.nonevents.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            base_rate=n_events/n
+            bs=self.sq_error/n
+            bss=1-bs/(base_rate*(1-base_rate))
+            pod=hits/(hits+misses)
+            pofd=false_alarms/false_alarms[:, :1]
+            sr=np.where(hits+false_alarms>0, hits/(hits+false_alarms), 1.)
+            csi=hits/(hits+misses+false_alarms)
+        #Curves run from threshold 0 (everything forecast yes) to 1; close them at (0, 0) for ROC and POD=0 for PR
+        pod_c=np.concatenate([pod, np.zeros((len(pod), 1))], axis=1)
+        pofd_c=np.concatenate([pofd, np.zeros((len(pod), 1))], axis=1)
+        sr_c=np.concatenate([sr, np.ones((len(pod), 1))], axis=1)
+        auc=-np.trapezoid(pod_c, pofd_c, axis=1) if hasattr(np, 'trapezoid') else -np.trapz(pod_c, pofd_c, axis=1)
+        aupdc=-np.trapezoid(sr_c, pod_c, axis=1) if hasattr(np, 'trapezoid') else -np.trapz(sr_c, pod_c, axis=1)
+        csi_filled=np.nan_to_num(csi, nan=-1.)
+        best=np.argmax(csi_filled, axis=1)
+        return {'bs':bs, 'bss':bss, 'auc':auc, 'aupdc':aupdc, 'max_csi':csi_filled[np.arange(len(best)), best],
+                'max_csi_threshold':best/self.n_bins, 'base_rate':base_rate}
+
+    def summary(self):
+        '''Returns a dataframe of scores, one row per forecast'''
+        return pd.DataFrame(self.scores(), index=pd.Index(self.names, name='forecast'))
+
+    def _index(self, name):
+        return self.names.index(name)
+
+    def reliability(self, name):
+        '''Returns the reliability diagram of a forecast: mean forecast probability, observed frequency, and count per bin'''
+        i=self._index(name)
+        count=self.events[i]+self.nonevents[i]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return pd.DataFrame({'bin_lower':np.arange(self.n_bins)/self.n_bins, 'mean_forecast':self.prob_sum[i]/count,
+                                 'observed_frequency':self.events[i]/count, 'count':count})
+
+    def curves(self, name):
+        '''Returns POD, POFD, success ratio, and CSI at each threshold (forecast yes for p >= threshold), for ROC and performance diagrams'''
+        i=self._index(name)
+        hits, false_alarms, misses, _=self._contingency()
+        h, f, m=hits[i], false_alarms[i], misses[i]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return pd.DataFrame({'threshold':np.arange(self.n_bins)/self.n_bins, 'pod':h/(h+m), 'pofd':f/f[0],
+                                 'success_ratio':h/(h+f), 'csi':h/(h+m+f)})
+
+
+def _forecast_matrix(forecasts):
+    #Returns names and an (n, n_forecasts) view/array of forecasts given as a dict of arrays or a dataframe
+    if hasattr(forecasts, 'columns'):
+        return list(forecasts.columns), forecasts
+    names=list(forecasts)
+    return names, forecasts
+
+def _chunk_matrix(forecasts, names, start, stop):
+    if hasattr(forecasts, 'iloc'):
+        return forecasts.iloc[start:stop].to_numpy(dtype=np.float64)
+    return np.column_stack([np.asarray(forecasts[name][start:stop], dtype=np.float64) for name in names])
+
+def score_forecasts(y, forecasts, n_bins=100, chunk_size=1000000):
+    '''Scores several forecasts of the same targets in one pass over the data'''
+    '''Params:
+    y: array of targets (0, 1)
+    forecasts: dict of {name: probabilities} or a dataframe with one column per forecast
+    n_bins: number of probability bins
+    chunk_size: rows binned at a time, which bounds the memory used
+    '''
+    '''Returns a ForecastHistogram. Use .summary(), .reliability(name), .curves(name)'''
+    names, forecasts=_forecast_matrix(forecasts)
+    y=np.asarray(y)
+    hist=ForecastHistogram(names, n_bins)
+    with stage('score_forecasts', rows=len(y), forecasts=len(names)):
+        for start in range(0, len(y), chunk_size):
+            hist.update(y[start:start+chunk_size], _chunk_matrix(forecasts, names, start, start+chunk_size))
+    return hist
+
+def score_chunks(chunks, names, n_bins=100):
+    '''Scores forecasts arriving in chunks of (y, forecasts), e.g. one case date at a time. Returns a ForecastHistogram'''
+    hist=ForecastHistogram(names, n_bins)
+    for y, forecasts in chunks:
+        hist.update(y, _chunk_matrix(forecasts, names, 0, len(y)))
+    return hist
+
+
+#################
+###Bootstrap###
+#################
+
+_boot=None
+
+def _init_bootstrap_worker(y, bins, P, groups, names, n_bins):
+    #Process pool initializer, so the binned data is sent to each worker once
+    global _boot
+    _boot=(y, bins, P, groups, names, n_bins)
+
+def _bootstrap_worker(seeds):
+    #Scores for each seed, using Poisson(1) resampling weights for each row (or group of rows)
+    y, bins, P, groups, names, n_bins=_boot
+    results=[]
+    for seed in seeds:
+        rng=np.random.default_rng(seed)
+        if groups is None:
+            weights=rng.poisson(1., len(y)).astype(np.float64)
+        else:
+            weights=rng.poisson(1., groups.max()+1).astype(np.float64)[groups]
+        hist=ForecastHistogram(names, n_bins)
+        hist._accumulate(y, P, bins, weights)
+        results.append(hist.scores())
+    return results
+
+def bootstrap_scores(y, forecasts, n_boot=1000, n_bins=100, groups=None, n_jobs=4, seed=42, ci=(2.5, 97.5)):
+    '''Bootstrap confidence intervals of the scores of several forecasts, computed on a process pool'''
+    '''Params:
+    y, forecasts, n_bins: as in score_forecasts
+    n_boot: number of bootstrap replicates
+    groups: array of group labels (e.g. case dates) per row. If given, whole groups are resampled together
+    n_jobs: number of worker processes. 1 runs in this process
+    seed: seed of the replicates, for reproducibility
+    ci: lower and upper percentiles of the interval
+    '''
+    '''Replicates use the Poisson bootstrap: every row (or group) gets a Poisson(1) weight, which is added to the same binned counts'''
+    '''Returns a dataframe indexed by (forecast, score) with the lower and upper bounds'''
+    names, forecasts=_forecast_matrix(forecasts)
+    y=np.asarray(y, dtype=np.float64)
+    P=_chunk_matrix(forecasts, names, 0, len(y))
+    bins=_bin_index(P, n_bins)
+    groups=None if groups is None else pd.factorize(np.asarray(groups))[0]
+    seeds=np.random.SeedSequence(seed).generate_state(n_boot)
+    batches=[batch for batch in np.array_split(seeds, max(1, n_jobs*4)) if len(batch)]
+
+    with stage('bootstrap_scores', rows=len(y), forecasts=len(names), n_boot=n_boot):
+        if n_jobs==1:
+            _init_bootstrap_worker(y, bins, P, groups, names, n_bins)
+            replicates=[scores for batch in batches for scores in _bootstrap_worker(batch)]
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_bootstrap_worker, initargs=(y, bins, P, groups, names, n_bins)) as pool:
+                replicates=[scores for result in pool.map(_bootstrap_worker, batches) for scores in result]
+
+    rows=[]
+    for score in SCORES:
+        values=np.stack([replicate[score] for replicate in replicates]) #(n_boot, n_forecasts)
+        lower, upper=np.nanpercentile(values, ci, axis=0)
+        for i, name in enumerate(names):
+            rows.append({'forecast':name, 'score':score, 'lower':lower[i], 'upper':upper[i]})
+    return pd.DataFrame(rows).set_index(['forecast', 'score']).sort_index(level='forecast', sort_remaining=False)
+
+
+###############
+###Baselines###
+###############
+
+def applicable_baselines(target_scale, timescale, hazard_names=None, columns=None):
+    '''Returns the unique baseline columns from get_bl_col for a target scale and timescale'''
+    '''hazard_names: hazards to include, e.g. ['hail_severe']. All hazards by default
+    columns: if given, only baselines present in columns are returned'''
+    from VargaPy.MlUtils import get_bl_col
+    hazard_names=BL_HAZARDS if hazard_names is None else hazard_names
+    baselines=list(dict.fromkeys(get_bl_col(str(target_scale), hazard, timescale) for hazard in hazard_names))
+    if columns is not None:
+        baselines=[col for col in baselines if col in set(columns)]
+    return baselines
+
+def verify_ml_and_baselines(y, ml_probs, baseline_data, target_scale, hazard_name, timescale, all_baselines=False, n_bins=100, n_boot=0, groups=None, n_jobs=4, ml_name='ML'):
+    '''Scores ML probabilities and the applicable NMEP baselines against the same targets in one pass'''
+    '''Params:
+    y: array of targets
+    ml_probs: array of ML probabilities, or dict {name: probabilities} to score several models
+    baseline_data: dataframe holding the baseline columns for the same rows, e.g. X_test
+    target_scale, hazard_name, timescale: as in get_bl_col
+    all_baselines: If true, every baseline for the target_scale/timescale is scored, not just the one for hazard_name
+    n_boot: number of bootstrap replicates for confidence intervals. 0 skips the bootstrap
+    groups, n_jobs: as in bootstrap_scores
+    '''
+    '''Returns the ForecastHistogram, and the bootstrap intervals (None if n_boot is 0)'''
+    baselines=applicable_baselines(target_scale, timescale, None if all_baselines else [hazard_name], baseline_data.columns)
+    missing=set(applicable_baselines(target_scale, timescale, None if all_baselines else [hazard_name]))-set(baselines)
+    if missing:
+        logger.warning(f'Baseline columns not found: {sorted(missing)}')
+    forecasts=dict(ml_probs) if isinstance(ml_probs, dict) else {ml_name: ml_probs}
+    for col in baselines:
+        forecasts[col]=baseline_data[col].to_numpy()
+    hist=score_forecasts(y, forecasts, n_bins=n_bins)
+    cis=bootstrap_scores(y, forecasts, n_boot=n_boot, n_bins=n_bins, groups=groups, n_jobs=n_jobs) if n_boot else None
+    return hist, cis
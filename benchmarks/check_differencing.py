@@ -0,0 +1,109 @@
+#Regression check of the VargaPy differencing functions against the original loop implementations
+#The legacy conventions must hold exactly: x is axis=0 (columns), y is axis=1 (rows counted from the top, so forward/centered
+#y derivatives are sign flipped and row 0 is zero). Usage:
+#   python benchmarks/check_differencing.py
+
+#########
+#Imports#
+#########
+
+import sys
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import numpy as np
+from VargaPy import VargaPy
+
+#####################
+###Legacy versions###
+#####################
+#Copied from VargaPy.py before the array-slicing rewrite. Only the indentation differs
+
+def legacy_forward_differencing(X, delta_x, axis=0):
+    length=np.shape(X)
+    df_dx=np.zeros_like(X)
+    i=0 #X
+    j=length[0]-1 #Y
+    if axis==0:
+        while i<length[1]-1:
+            df_dx[:,i]=(X[:,i+1]-X[:,i])/delta_x
+            i+=1
+    elif axis==1:
+        while j>0:
+            df_dx[j,:]=(X[j-1,:]-X[j,:])/delta_x
+            j-=1
+    return df_dx
+
+def legacy_backward_differencing(X, delta_x, axis=0):
+    length=np.shape(X)
+    df_dx=np.zeros_like(X)
+    i=1 #X
+    j=1 #Y
+    if axis==0:
+        while i<length[1]:
+            df_dx[:,i]=(X[:,i]-X[:,i-1])/delta_x
+            i+=1
+    elif axis==1:
+        while j<length[0]:
+            df_dx[j,:]=(X[j,:]-X[j-1,:])/delta_x
+            j+=1
+    return df_dx
+
+def legacy_centered_differencing(X, delta_x, axis=0):
+    length=np.shape(X)
+    df_dx=np.zeros_like(X)
+    i=1 #Index for x, starts at 1 to avoid boundary issues
+    j=length[0]-2 #index for y, starts at the second to last index and moves up
+    if axis==0:
+        while i<length[1]-1:
+            df_dx[:,i]=(X[:,i+1]-X[:,i-1])/(2*delta_x)
+            i+=1
+    if axis==1:
+        while j>0:
+            df_dx[j,:]=(X[j-1,:]-X[j+1,:])/(2*delta_x)
+            j-=1
+    return df_dx
+
+###########
+###Check###
+###########
+
+SCHEMES=['forward', 'backward', 'centered']
+
+def check(seed=42):
+    '''Returns a list of mismatches between the current and legacy differencing functions. Empty if they all match exactly'''
+    rng=np.random.default_rng(seed)
+    failures=[]
+    cases={'2D float64':rng.standard_normal((7, 9)),
+           '2D float32':rng.standard_normal((9, 7)).astype(np.float32),
+           'single row':rng.standard_normal((1, 5)),
+           'single column':rng.standard_normal((5, 1)),
+           'batched (member, time, y, x)':rng.standard_normal((3, 2, 6, 8))}
+    for name, X in cases.items():
+        for scheme in SCHEMES:
+            new=getattr(VargaPy, f'{scheme}_differencing')
+            old=globals()[f'legacy_{scheme}_differencing']
+            for axis in (0, 1):
+                result=new(X, 3000., axis=axis)
+                #The legacy functions only take 2D arrays, so batched input is checked one (y, x) slice at a time
+                expected=np.stack([old(x, 3000., axis=axis) for x in X.reshape(-1, *X.shape[-2:])]).reshape(X.shape)
+                if result.dtype!=expected.dtype or not np.array_equal(result, expected):
+                    failures.append(f'{scheme} axis={axis} {name}')
+
+    #Intentional change: integer input now gives a float64 derivative. The legacy functions returned X's integer dtype (truncated)
+    X=rng.integers(0, 100, (6, 6))
+    for scheme in SCHEMES:
+        for axis in (0, 1):
+            result=getattr(VargaPy, f'{scheme}_differencing')(X, 3., axis=axis)
+            expected=globals()[f'legacy_{scheme}_differencing'](X.astype(np.float64), 3., axis=axis)
+            if result.dtype!=np.float64 or not np.array_equal(result, expected):
+                failures.append(f'{scheme} axis={axis} integer input')
+    return failures
+
+if __name__=='__main__':
+    failures=check()
+    for failure in failures:
+        print(f'MISMATCH: {failure}')
+    print('All differencing results match the legacy implementation' if not failures else f'{len(failures)} mismatches')
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,138 @@
+#Check of VargaPy.Downloads against a local http.server: retries, resume, skipping existing files, and atomic writes
+#Runs offline. Usage:
+#   python benchmarks/check_downloads.py
+
+#########
+#Imports#
+#########
+
+import sys
+import tempfile
+import threading
+from os.path import join, exists, dirname, abspath
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from VargaPy import Downloads
+
+BODY=bytes(range(256))*64
+
+############
+###Server###
+############
+
+class Handler(BaseHTTPRequestHandler):
+    '''Serves BODY with a behaviour chosen by the path. hits, ranges, and clients record every request per path'''
+    protocol_version='HTTP/1.1' #Keep-alive, as the real servers
+    hits={}
+    ranges={}
+    clients={}
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b'', length=None, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body) if length is None else length))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        hit=self.hits[self.path]=self.hits.get(self.path, 0)+1
+        self.ranges.setdefault(self.path, []).append(self.headers.get('Range'))
+        self.clients.setdefault(self.path, set()).add(self.client_address)
+        if self.path in ('/retry/503', '/retry/429', '/retry/408') and hit==1:
+            self._send(int(self.path[-3:]))
+        elif self.path=='/missing':
+            self._send(404)
+        elif self.path=='/always-500':
+            self._send(500)
+        elif self.path=='/always-cut' or (self.path=='/cut-once' and hit==1):
+            #Promises the whole file, sends half of it, and drops the connection
+            self._send(200, BODY[:len(BODY)//2], length=len(BODY))
+            self.close_connection=True
+        elif self.headers.get('Range'):
+            offset=int(self.headers['Range'].split('=')[1].rstrip('-'))
+            self._send(206, BODY[offset:], headers=[('Content-Range', f'bytes {offset}-{len(BODY)-1}/{len(BODY)}')])
+        else:
+            self._send(200, BODY)
+
+###########
+###Check###
+###########
+
+def check():
+    '''Returns a list of failed checks. Empty if they all pass'''
+    failures=[]
+    server=ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base=f'http://127.0.0.1:{server.server_address[1]}'
+
+    def expect(name, condition):
+        if not condition:
+            failures.append(name)
+
+    def fetch(path, dest, **kwargs):
+        try:
+            return Downloads.fetch(base+path, dest, retries=2, backoff=0.01, **kwargs)
+        except Exception as err:
+            return err
+
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for status in ('503', '429', '408'):
+                dest=join(workdir, f'retry_{status}')
+                expect(f'{status} is retried', fetch(f'/retry/{status}', dest)==len(BODY) and open(dest, 'rb').read()==BODY
+                       and Handler.hits[f'/retry/{status}']==2)
+
+            dest=join(workdir, 'missing')
+            result=fetch('/missing', dest)
+            expect('404 raises HTTPError', isinstance(result, Downloads.HTTPError) and result.status==404)
+            expect('404 is not retried', Handler.hits['/missing']==1)
+            expect('404 leaves no file', not exists(dest) and not exists(dest+'.part'))
+
+            dest=join(workdir, 'resumed')
+            expect('interrupted download is resumed', fetch('/cut-once', dest)==len(BODY)-len(BODY)//2 and open(dest, 'rb').read()==BODY)
+            expect('resume sends Range from the partial size', Handler.ranges['/cut-once']==[None, f'bytes={len(BODY)//2}-'])
+            expect('resumed download leaves no .part file', not exists(dest+'.part'))
+
+            dest=join(workdir, 'existing')
+            with open(dest, 'wb') as f:
+                f.write(b'old')
+            expect('existing file is skipped', fetch('/skip', dest)==0 and '/skip' not in Handler.hits and open(dest, 'rb').read()==b'old')
+            expect('overwrite replaces an existing file', fetch('/skip', dest, overwrite=True)==len(BODY) and open(dest, 'rb').read()==BODY)
+
+            dest=join(workdir, 'cut')
+            result=fetch('/always-cut', dest)
+            expect('failed download raises after the retries', isinstance(result, Downloads.RETRY_ERRORS) and Handler.hits['/always-cut']==3)
+            expect('failed download never writes dest', not exists(dest) and exists(dest+'.part'))
+
+            dest=join(workdir, 'server_error')
+            result=fetch('/always-500', dest)
+            expect('persistent 500 raises after the retries', isinstance(result, Downloads.HTTPError) and Handler.hits['/always-500']==3)
+            expect('persistent 500 never writes dest', not exists(dest))
+
+            pool=Downloads.ConnectionPool()
+            for i in range(3):
+                fetch(f'/reuse/{i}', join(workdir, 'reuse', str(i)), pool=pool)
+            expect('sequential downloads reuse one connection', len(set.union(*(Handler.clients.get(f'/reuse/{i}', set()) for i in range(3))))==1
+                   and all(open(join(workdir, 'reuse', str(i)), 'rb').read()==BODY for i in range(3)))
+
+            jobs=[(f'{base}/many/{i}', join(workdir, 'many', str(i))) for i in range(8)]+[(f'{base}/missing', join(workdir, 'many', 'missing'))]
+            results=Downloads.fetch_many(jobs, max_workers=4, retries=0)
+            expect('fetch_many downloads every file', all(results[dest]==len(BODY) for _, dest in jobs[:-1]))
+            expect('fetch_many returns the error for a failed file', isinstance(results[jobs[-1][1]], Downloads.HTTPError))
+    finally:
+        server.shutdown()
+        server.server_close()
+    return failures
+
+if __name__=='__main__':
+    failures=check()
+    for failure in failures:
+        print(f'FAILED: {failure}')
+    print('All download checks passed' if not failures else f'{len(failures)} failed checks')
+    sys.exit(1 if failures else 0)
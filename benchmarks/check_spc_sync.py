@@ -0,0 +1,122 @@
+#Check of SPC_Outlook.sync_spc_products against a local stand-in catalog: manifest contents, incremental re-runs, and the product index
+#Runs offline. Requires pandas and beautifulsoup4. Usage:
+#   python benchmarks/check_spc_sync.py
+
+#########
+#Imports#
+#########
+
+import os
+import sys
+import tempfile
+import threading
+import functools
+from zipfile import ZipFile
+from os.path import join, exists, dirname, abspath
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from VargaPy import SPC_Outlook
+
+#############
+###Catalog###
+#############
+
+def write_kmz(path, begin, end):
+    '''Writes a KMZ whose KML has a TimeSpan from begin to end, as the SPC watch and mesoscale discussion files'''
+    os.makedirs(dirname(path), exist_ok=True)
+    kml=('<kml xmlns="http://www.opengis.net/kml/2.2"><Document><Placemark>'
+         f'<TimeSpan><begin>{begin}</begin><end>{end}</end></TimeSpan></Placemark></Document></kml>')
+    with ZipFile(path, 'w') as ZF:
+        ZF.writestr('doc.kml', kml)
+
+class Handler(SimpleHTTPRequestHandler):
+    '''Serves the catalog directory, with directory listings as the yearly catalogs. Paths in missing return 404; requests records every path'''
+    protocol_version='HTTP/1.1'
+    requests=[]
+    missing=set()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.path in self.missing:
+            self.send_error(404)
+        else:
+            super().do_GET()
+
+###########
+###Check###
+###########
+
+def check():
+    '''Returns a list of failed checks. Empty if they all pass'''
+    failures=[]
+
+    def expect(name, condition):
+        if not condition:
+            failures.append(name)
+
+    def downloaded(summary):
+        return {product: result['downloaded'] for product, result in summary.items()}
+
+    with tempfile.TemporaryDirectory() as workdir:
+        served, local=join(workdir, 'served'), join(workdir, 'local')
+        for i in range(1, 4):
+            write_kmz(join(served, 'md', '2019', f'md{i:04d}.kmz'), f'2019-05-0{i}T18:00:00Z', f'2019-05-0{i}T20:00:00Z')
+        write_kmz(join(served, 'watch', '2019', 'ww0001.kmz'), '2019-05-02T19:00:00Z', '2019-05-03T01:00:00Z')
+
+        server=ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=served))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base=f'http://127.0.0.1:{server.server_address[1]}'
+        urls={product: f'{base}/{product}' for product in SPC_Outlook.SPC_PRODUCTS}
+        sync=functools.partial(SPC_Outlook.sync_spc_products, 2019, local, urls=urls, max_workers=2, retries=0, backoff=0.01)
+
+        try:
+            summary=sync()
+            expect('first sync downloads every file', downloaded(summary)=={'md':3, 'watch':1})
+            manifest=SPC_Outlook.read_manifest(join(local, 'md', '2019', 'manifest.json'))
+            expect('manifest lists every downloaded file', sorted(manifest)==['md0001.kmz', 'md0002.kmz', 'md0003.kmz'])
+            expect('manifest records size and valid times', manifest['md0002.kmz']=={'url':f'{base}/md/2019/md0002.kmz',
+                   'bytes':os.path.getsize(join(local, 'md', '2019', 'md0002.kmz')),
+                   'valid_start':'2019-05-02T18:00:00Z', 'valid_end':'2019-05-02T20:00:00Z'})
+
+            del Handler.requests[:]
+            summary=sync()
+            expect('re-run downloads nothing', downloaded(summary)=={'md':0, 'watch':0})
+            expect('re-run only requests the catalogs', sorted(Handler.requests)==['/md/2019/', '/watch/2019/'])
+
+            write_kmz(join(served, 'md', '2019', 'md0004.kmz'), '2019-05-04T18:00:00Z', '2019-05-04T20:00:00Z')
+            write_kmz(join(served, 'watch', '2019', 'ww0002.kmz'), '2019-05-04T17:00:00Z', '2019-05-04T23:00:00Z')
+            Handler.missing.add('/watch/2019/ww0002.kmz')
+            os.remove(join(local, 'md', '2019', 'md0001.kmz'))
+            summary=sync()
+            expect('new and locally deleted files are downloaded', downloaded(summary)=={'md':2, 'watch':0})
+            expect('failed download is reported', list(summary['watch']['failed'])==['ww0002.kmz'])
+            expect('failed download is left out of the manifest',
+                   'ww0002.kmz' not in SPC_Outlook.read_manifest(join(local, 'watch', '2019', 'manifest.json')))
+            expect('failed download leaves no file', not exists(join(local, 'watch', '2019', 'ww0002.kmz')))
+
+            Handler.missing.clear()
+            summary=sync()
+            expect('failed download is retried on the next run', downloaded(summary)=={'md':0, 'watch':1})
+
+            index=SPC_Outlook.load_product_index(local)
+            expect('index has one row per file, sorted by valid time', list(index['file'])==['md0001.kmz', 'md0002.kmz', 'ww0001.kmz', 'md0003.kmz',
+                                                                                              'ww0002.kmz', 'md0004.kmz'])
+            valid=SPC_Outlook.products_valid_at(index, '2019-05-02 19:30')
+            expect('products_valid_at finds the overlapping products', sorted(valid['file'])==['md0002.kmz', 'ww0001.kmz'])
+            expect('products_valid_at finds nothing between products', len(SPC_Outlook.products_valid_at(index, '2019-05-03 12:00'))==0)
+        finally:
+            server.shutdown()
+            server.server_close()
+    return failures
+
+if __name__=='__main__':
+    failures=check()
+    for failure in failures:
+        print(f'FAILED: {failure}')
+    print('All SPC sync checks passed' if not failures else f'{len(failures)} failed checks')
+    sys.exit(1 if failures else 0)
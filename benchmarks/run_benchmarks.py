@@ -0,0 +1,217 @@
+#Benchmark suite for the VargaPy hot paths
+#Runs offline on synthetic data. Usage:
+#   python benchmarks/run_benchmarks.py --size small                    #Run and compare against the stored baseline
+#   python benchmarks/run_benchmarks.py --size medium --save-baseline   #Store the results as the new baseline
+#   python benchmarks/run_benchmarks.py -k differencing thermo          #Only benchmarks whose name contains a keyword
+#   python benchmarks/run_benchmarks.py -k import                       #Package startup time
+
+#########
+#Imports#
+#########
+
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+from os.path import join, dirname, abspath, exists
+
+HERE=dirname(abspath(__file__))
+sys.path.insert(0, join(HERE, 'stand_in')) #Stand-in main.io, so MlUtils imports without the ML repo
+sys.path.insert(0, dirname(HERE))
+sys.path.insert(0, HERE)
+
+import numpy as np
+import synthetic
+
+#Problem sizes. rows: ML dataset rows, grid: (member, time, y, x)
+SIZES={'small':{'rows':20000, 'grid':(4, 3, 150, 150), 'outlook_dates':5},
+       'medium':{'rows':200000, 'grid':(18, 6, 300, 300), 'outlook_dates':30},
+       'large':{'rows':1000000, 'grid':(18, 12, 300, 300), 'outlook_dates':120}}
+
+BENCHMARKS={}
+
+def benchmark(name, requires=()):
+    '''Registers a benchmark. The decorated function takes (size, workdir) and returns a zero-argument callable to time'''
+    def register(setup):
+        BENCHMARKS[name]=(setup, requires)
+        return setup
+    return register
+
+###############
+###Benchmarks##
+###############
+
+@benchmark('differencing_centered')
+def _differencing(size, workdir):
+    from VargaPy import VargaPy
+    F,=synthetic.make_grid_fields(size['grid'], n_fields=1)
+    out=np.empty_like(F)
+    return lambda: (VargaPy.centered_differencing(F, 3000., axis=0, out=out), VargaPy.centered_differencing(F, 3000., axis=1, out=out))
+
+@benchmark('kinematics')
+def _kinematics(size, workdir):
+    from VargaPy import VargaPy
+    u, v=synthetic.make_grid_fields(size['grid'])
+    return lambda: VargaPy.kinematics(u, v, 3000., fields=VargaPy.KINEMATIC_FIELDS)
+
+@benchmark('thermodynamics')
+def _thermo(size, workdir):
+    from VargaPy import VargaPy
+    T, P, w=synthetic.make_thermo_fields(size['grid'])
+    return lambda: VargaPy.moist_thermo(T, P, w)
+
+@benchmark('ensemble_stats')
+def _ensemble_stats(size, workdir):
+    from VargaPy import VargaPy
+    F,=synthetic.make_grid_fields(size['grid'], n_fields=1)
+    out={stat: np.empty(F.shape[1:], dtype=np.float32) for stat in ('mean', 'IQR', '2nd', '16th', '90th')}
+    return lambda: VargaPy.ensemble_stats(F, stats=tuple(out), out=out)
+
+@benchmark('nmep')
+def _nmep(size, workdir):
+    from VargaPy import VargaPy
+    F,=synthetic.make_grid_fields(size['grid'], n_fields=1)
+    return lambda: VargaPy.nmep(F, thresholds=(0.5, 0.75, 1.), scales_km=(9, 27, 45), time_axis=1)
+
+@benchmark('all_severe', requires=('pyarrow',))
+def _all_severe(size, workdir):
+    from VargaPy import MlUtils
+    synthetic.write_ml_dataset(workdir, size['rows'], modes=('train',))
+    data_file=synthetic.ml_data_file(workdir)
+    return lambda: MlUtils.All_Severe(workdir, data_file=data_file)
+
+@benchmark('drop_unwanted_variables', requires=('pyarrow',))
+def _drop(size, workdir):
+    from VargaPy import MlUtils
+    X=synthetic.make_ml_dataframe(size['rows'])[synthetic.predictor_names()]
+    return lambda: [MlUtils.Drop_Unwanted_Variables(X, original=original, training_scale=scale, envOnly=env)
+                    for original in (False, True) for scale in (False, 9, 27, 45) for env in (False, True)]
+
+@benchmark('pseudo_all_severe_probs')
+def _pseudo(size, workdir):
+    from VargaPy import MlUtils
+    X=synthetic.make_ml_dataframe(size['rows'])[synthetic.predictor_names()[3:]]
+    models=synthetic.make_hazard_models(X.shape[1])
+    return lambda: MlUtils.pseudo_all_severe_probs(models, X, chunk_size=50000, n_jobs=4)
+
+@benchmark('spc_outlook_load', requires=('geopandas',))
+def _outlook(size, workdir):
+    from VargaPy.SPC_Outlook import SPCoutlook
+    dates=[f'2019{5+i//28:02d}{1+i%28:02d}' for i in range(size['outlook_dates'])]
+    for i, date in enumerate(dates):
+        synthetic.write_spc_outlook_archive(workdir, date, seed=i)
+    return lambda: [SPCoutlook(date, category, workdir).outlook for date in dates for category in ('cat', 'wind')]
+
+def _import_time(module):
+    #Times a cold import of module in a fresh interpreter
+    import subprocess
+    env=dict(os.environ, PYTHONPATH=os.pathsep.join([dirname(HERE), join(HERE, 'stand_in')]))
+    return lambda: subprocess.run([sys.executable, '-c', f'import {module}'], check=True, env=env)
+
+@benchmark('import_vargapy')
+def _import_vargapy(size, workdir):
+    return _import_time('VargaPy.VargaPy')
+
+@benchmark('import_mlutils')
+def _import_mlutils(size, workdir):
+    return _import_time('VargaPy.MlUtils')
+
+@benchmark('import_spc_outlook')
+def _import_spc_outlook(size, workdir):
+    return _import_time('VargaPy.SPC_Outlook')
+
+@benchmark('import_heavy_modules_not_loaded')
+def _import_heavy(size, workdir):
+    #Fails if importing the package pulls in any of the heavy dependencies
+    import subprocess
+    env=dict(os.environ, PYTHONPATH=os.pathsep.join([dirname(HERE), join(HERE, 'stand_in')]))
+    check=('import sys, VargaPy.MlUtils, VargaPy.SPC_Outlook, VargaPy.VargaPy; '
+           'loaded=[m for m in ("pandas", "geopandas", "matplotlib", "bs4", "shapely", "main.io") if m in sys.modules]; '
+           'sys.exit(f"Imported at startup: {loaded}") if loaded else None')
+    return lambda: subprocess.run([sys.executable, '-c', check], check=True, env=env)
+
+####################
+###Timing/Memory###
+####################
+
+def _available(modules):
+    for module in modules:
+        try:
+            __import__(module)
+        except ImportError:
+            return False
+    return True
+
+def run_benchmark(name, size, repeat=3):
+    '''Returns a dict with the best wall time (s) over repeat runs and the peak traced memory (MB) of one run'''
+    setup, requires=BENCHMARKS[name]
+    if not _available(requires):
+        return {'skipped':f'requires {", ".join(requires)}'}
+    with tempfile.TemporaryDirectory() as workdir:
+        func=setup(SIZES[size], workdir)
+        times=[]
+        for _ in range(repeat):
+            gc.collect()
+            t0=time.perf_counter()
+            func()
+            times.append(time.perf_counter()-t0)
+        gc.collect()
+        tracemalloc.start()
+        func()
+        peak=tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'time':min(times), 'peak_mb':peak/1024**2}
+
+def compare(results, baseline, tolerance):
+    '''Returns a list of (name, metric, old, new) that regressed by more than tolerance (fraction) against baseline'''
+    regressions=[]
+    for name, result in results.items():
+        if name not in baseline or 'skipped' in result or 'skipped' in baseline[name]:
+            continue
+        for metric in ('time', 'peak_mb'):
+            old, new=baseline[name][metric], result[metric]
+            if new>old*(1+tolerance):
+                regressions.append((name, metric, old, new))
+    return regressions
+
+def main():
+    parser=argparse.ArgumentParser(description='Benchmarks for VargaPy hot paths on synthetic data')
+    parser.add_argument('-s', '--size', default='small', choices=list(SIZES), help='Problem size')
+    parser.add_argument('-k', '--keyword', nargs='+', help='Only run benchmarks whose name contains one of these')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Timed repetitions; the fastest is reported')
+    parser.add_argument('-b', '--baseline', default=join(HERE, 'baseline.json'), help='Baseline results file')
+    parser.add_argument('--save-baseline', action='store_true', help='Store these results in the baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed fractional slowdown/memory growth before a regression is reported')
+    args=parser.parse_args()
+    
+    names=[name for name in BENCHMARKS if not args.keyword or any(k in name for k in args.keyword)]
+    results={}
+    for name in names:
+        results[name]=run_benchmark(name, args.size, args.repeat)
+        result=results[name]
+        if 'skipped' in result:
+            print(f'{name:<32} skipped ({result["skipped"]})')
+        else:
+            print(f'{name:<32} {result["time"]:10.4f} s {result["peak_mb"]:10.1f} MB')
+    
+    stored=json.load(open(args.baseline)) if exists(args.baseline) else {}
+    if args.save_baseline:
+        stored.setdefault(args.size, {}).update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+        print(f'Saved baseline to {args.baseline}')
+        return 0
+    
+    regressions=compare(results, stored.get(args.size, {}), args.tolerance)
+    for name, metric, old, new in regressions:
+        print(f'REGRESSION {name} {metric}: {old:.4g} -> {new:.4g}')
+    if not stored.get(args.size):
+        print(f'No {args.size} baseline in {args.baseline}; run with --save-baseline to create one')
+    return 1 if regressions else 0
+
+if __name__=='__main__':
+    sys.exit(main())
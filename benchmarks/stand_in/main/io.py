@@ -0,0 +1,16 @@
+#Stand-in for main.io from the 2-6 hr ML repo, so MlUtils can be benchmarked offline
+#Reads the synthetic feather files written by benchmarks/synthetic.py
+
+import pandas as pd
+from os.path import join
+
+METADATA=['Run Date']
+
+def load_ml_data(base_path, mode='train', target_col=None, FRAMEWORK='POTVIN', TIMESCALE='2to6', appendUH=False, Three_km=False, full_9km=True):
+    '''Returns X, y, metadata, where X holds every column that is neither metadata nor a target'''
+    df=pd.read_feather(join(base_path, f'wofs_ml_severe__{TIMESCALE}hr__{mode}_data.feather'))
+    targets=[col for col in df.columns if '_severe__' in col]
+    y=df[target_col].to_numpy()
+    metadata=df[METADATA]
+    X=df.drop(columns=targets+METADATA)
+    return X, y, metadata
@@ -0,0 +1,126 @@
+#Synthetic data generators for the VargaPy benchmarks
+#Column names, file names and shapes mimic the WoFS ML datasets and SPC outlook archive, so the
+#benchmarks exercise the same code paths without access to the real data
+
+#########
+#Imports#
+#########
+
+import os
+from os.path import join
+import numpy as np
+import pandas as pd
+
+ENS_VARS=['uh_2to5_instant', 'uh_0to2_instant', 'wz_0to2_instant', 'comp_dz', 'ws_80', 'hailcast', 'w_up', 'okubo_weiss']
+ENV_VARS=['cape_ml', 'cin_ml', 'srh_0to1', 'srh_0to3', 'shear_u_0to6', 'shear_v_0to6', 'lcl_ml', 'mid_level_lapse_rate',
+          'low_level_lapse_rate', 'temperature_850', 'td_2', 'geopotential_height_500', 'pbl_height', 'theta_e_ml']
+ENS_STATS=['mean', 'IQR', '2nd', '16th', '90th']
+ENV_STATS=['mean', 'std']
+SCALES=['9km', '27km', '45km']
+HAZARDS=['wind', 'hail', 'tornado']
+TARGET_SCALES=[9, 18, 36]
+METADATA=['Run Date']
+
+def ml_data_file(base_path, mode='train', TIMESCALE='2to6'):
+    '''Path of the feather file read by the stand-in load_ml_data'''
+    return join(base_path, f'wofs_ml_severe__{TIMESCALE}hr__{mode}_data.feather')
+
+def predictor_names(n_env=len(ENV_VARS), n_ens=len(ENS_VARS)):
+    '''Returns predictor names of the form variable__category__neighborhood__statistic'''
+    names=['NX', 'NY', 'Init Time']
+    for var in ENS_VARS[:n_ens]:
+        names+=[f'{var}__time_max__{scale}__{stat}' for scale in SCALES for stat in ENS_STATS]
+    for var in ENV_VARS[:n_env]:
+        names+=[f'{var}__time_avg__{scale}__{stat}' for scale in SCALES for stat in ENV_STATS]
+    return names
+
+def make_ml_dataframe(n_rows, n_dates=20, base_rate=0.02, seed=42, n_env=len(ENV_VARS), n_ens=len(ENS_VARS)):
+    '''Returns a dataframe like the ML feather files: metadata, float32 predictors, and severe/sig-severe targets'''
+    rng=np.random.default_rng(seed)
+    dates=pd.date_range('20190501', periods=n_dates).strftime('%Y%m%d')
+    df={'Run Date': np.sort(rng.choice(dates, n_rows))}
+    for name in predictor_names(n_env, n_ens):
+        if name in ('NX', 'NY'):
+            df[name]=rng.integers(0, 300, n_rows)
+        else:
+            df[name]=rng.standard_normal(n_rows, dtype=np.float32)
+    for hazard in HAZARDS:
+        for scale in TARGET_SCALES:
+            df[f'{hazard}_severe__{scale}km']=(rng.random(n_rows)<base_rate).astype(np.int64)
+            df[f'{hazard}_sig_severe__{scale}km']=(rng.random(n_rows)<base_rate/10).astype(np.int64)
+    return pd.DataFrame(df)
+
+def write_ml_dataset(base_path, n_rows, modes=('train', 'test'), TIMESCALE='2to6', **kwargs):
+    '''Writes synthetic ML feather files for each mode to base_path. Returns the list of files written'''
+    os.makedirs(base_path, exist_ok=True)
+    files=[]
+    for i, mode in enumerate(modes):
+        path=ml_data_file(base_path, mode, TIMESCALE)
+        make_ml_dataframe(n_rows, seed=kwargs.pop('seed', 42)+i, **kwargs).to_feather(path)
+        files.append(path)
+    return files
+
+def make_grid_fields(shape=(18, 12, 300, 300), n_fields=2, dtype=np.float32, seed=42):
+    '''Returns a list of smooth random fields with shape (member, time, y, x)'''
+    rng=np.random.default_rng(seed)
+    y=np.linspace(0, 4*np.pi, shape[-2], dtype=dtype)[:, None]
+    x=np.linspace(0, 4*np.pi, shape[-1], dtype=dtype)[None, :]
+    fields=[]
+    for _ in range(n_fields):
+        field=np.broadcast_to(np.sin(x+rng.random())*np.cos(y+rng.random()), shape).astype(dtype)
+        field+=0.1*rng.standard_normal(shape, dtype=np.float32).astype(dtype)
+        fields.append(field)
+    return fields
+
+def make_thermo_fields(shape=(18, 12, 300, 300), dtype=np.float32, seed=42):
+    '''Returns temperature (K), pressure (Pa) and mixing ratio (kg/kg) fields of the given shape'''
+    rng=np.random.default_rng(seed)
+    T=(290+10*rng.random(shape, dtype=np.float32)).astype(dtype)
+    P=(85000+15000*rng.random(shape, dtype=np.float32)).astype(dtype)
+    w=(0.004+0.012*rng.random(shape, dtype=np.float32)).astype(dtype)
+    return T, P, w
+
+class LogisticStandIn:
+    '''Minimal model with predict_proba, standing in for a fitted hazard model'''
+    def __init__(self, n_features, seed=0):
+        self.coef=np.random.default_rng(seed).normal(scale=0.1, size=n_features).astype(np.float32)
+    
+    def predict_proba(self, X):
+        p=1/(1+np.exp(-(np.asarray(X, dtype=np.float32)@self.coef)))
+        return np.stack([1-p, p], axis=1)
+
+def make_hazard_models(n_features, hazards=HAZARDS):
+    '''Returns a list of (name, model) pairs, as used by pseudo_all_severe_probs'''
+    return [(hazard, LogisticStandIn(n_features, seed=i)) for i, hazard in enumerate(hazards)]
+
+#DN values of each SPC outlook category, low to high
+OUTLOOK_DN={'cat':[2, 3, 4, 5, 6, 8], 'wind':[5, 15, 30, 45, 60], 'hail':[5, 15, 30, 45, 60], 'torn':[2, 5, 10, 15, 30, 45, 60]}
+
+def make_outlook_frame(category, n_vertices=200, seed=0):
+    '''Returns a GeoDataFrame of nested SPC-style outlook polygons (DN, geometry) in EPSG:4326'''
+    import geopandas as gpd
+    from shapely.geometry import Polygon
+    rng=np.random.default_rng(seed)
+    center=np.array([-97.5+rng.uniform(-5, 5), 37+rng.uniform(-3, 3)])
+    theta=np.linspace(0, 2*np.pi, n_vertices, endpoint=False)
+    dns=OUTLOOK_DN[category]
+    polys=[]
+    for i, dn in enumerate(dns):
+        radius=(len(dns)-i)*1.5*(1+0.1*rng.standard_normal(n_vertices).clip(-0.5, 0.5))
+        polys.append(Polygon(np.column_stack([center[0]+radius*np.cos(theta), center[1]+0.6*radius*np.sin(theta)])))
+    return gpd.GeoDataFrame({'DN':dns, 'geometry':polys}, crs='EPSG:4326')
+
+def write_spc_outlook_archive(base_path, date, categories=('cat', 'wind', 'hail', 'torn'), seed=0):
+    '''Writes day1otlk_{date}_1630-shp.zip and its extracted shapefiles to base_path/date, as SPCoutlook expects'''
+    from zipfile import ZipFile
+    out_dir=join(base_path, date)
+    os.makedirs(out_dir, exist_ok=True)
+    zip_path=join(out_dir, f'day1otlk_{date}_1630-shp.zip')
+    with ZipFile(zip_path, 'w') as ZF:
+        for i, category in enumerate(categories):
+            stem=f'day1otlk_{date}_1630_{category}'
+            make_outlook_frame(category, seed=seed+i).to_file(join(out_dir, f'{stem}.shp'))
+            for ext in ('shp', 'shx', 'dbf', 'prj', 'cpg'):
+                if os.path.exists(join(out_dir, f'{stem}.{ext}')):
+                    ZF.write(join(out_dir, f'{stem}.{ext}'), f'{stem}.{ext}')
+    return zip_path